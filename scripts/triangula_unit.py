@@ -1,3 +1,4 @@
+import os
 from time import sleep
 
 from approxeng.chassis.util import get_regular_triangular_chassis
@@ -5,20 +6,37 @@ from approxeng.input.selectbinder import ControllerResource
 from approxeng.task import register_task, register_resource, TaskStop, run, task
 from approxeng.task.menu import register_menu_tasks_from_yaml
 
-from triangula.hardware import Arduino, P017LCD, MPU9150
+from triangula.hardware import Arduino, P017LCD, MPU9150, I2CBus
 from triangula.manual_motion import ManualMotionTask
 from triangula.menu import TriangulaMenuClass
+from triangula.simulation import SimulatedHardware
+
+chassis = get_regular_triangular_chassis(wheel_distance=290,
+                                         wheel_radius=60,
+                                         max_rotations_per_second=1.0)
+
+if os.environ.get('TRIANGULA_SIMULATE'):
+    # Run against simulated hardware, handy for testing away from the robot
+    simulated_hardware = SimulatedHardware(chassis=chassis)
+    i2c_bus = simulated_hardware.bus
+    arduino = simulated_hardware.create_arduino()
+    mpu = simulated_hardware.create_mpu()
+    display = simulated_hardware.create_lcd()
+else:
+    # Single long-lived session on the I2C bus, shared by the Arduino and the IMU
+    i2c_bus = I2CBus(bus=1)
+    arduino = Arduino(bus=i2c_bus)
+    mpu = MPU9150(bus=i2c_bus)
+    display = P017LCD()
 
 # Register resources to be used by tasks
-register_resource('arduino', Arduino())
-register_resource('mpu', MPU9150())
-display = P017LCD()
+register_resource('arduino', arduino)
+register_resource('mpu', mpu)
 register_resource('display', display)
-register_resource('chassis', get_regular_triangular_chassis(wheel_distance=290,
-                                                            wheel_radius=60,
-                                                            max_rotations_per_second=1.0))
+register_resource('chassis', chassis)
 
-register_task(name='manual_motion', value=ManualMotionTask())
+# Set TRIANGULA_GYRO to fuse the IMU's gyro with odometry for the heading
+register_task(name='manual_motion', value=ManualMotionTask(use_gyro=bool(os.environ.get('TRIANGULA_GYRO'))))
 register_menu_tasks_from_yaml(filename='menu_definition.yaml',
                               menu_task_class=TriangulaMenuClass,
                               resources=['joystick', 'display'])
@@ -73,3 +91,6 @@ while True:
         # Raised if there's no available controller, display this information
         display.text = ['Triangula', 'No Controller']
         sleep(1)
+
+# Release the I2C bus
+i2c_bus.close()
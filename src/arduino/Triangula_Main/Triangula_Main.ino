@@ -26,10 +26,27 @@
 #define ENCODER_READ 0x22
 #define UPDATE_LED_GROUP 0x23
 
+// Protocol version 2 adds register select reads. A write of a single byte selects a register, and the next read
+// request is answered with a complete frame for that register in one go. Version 1 masters never send single byte
+// writes, so they see exactly the same behaviour as before.
+// Protocol version 3 adds DRIVE_AND_SAMPLE, which takes the same data as MOTOR_SPEED_SET and also selects a read of
+// the encoder positions along with a timestamp, so the master can set motor speeds and read the encoders in a single
+// combined write and read.
+#define PROTOCOL_VERSION 3
+#define PROTOCOL_VERSION_READ 0x24
+#define ENCODER_READ_BLOCK 0x25
+#define DRIVE_AND_SAMPLE 0x26
+// Encoder frame is three big-endian 16 bit positions, a sequence number and an XOR checksum
+#define ENCODER_FRAME_SIZE 8
+// Timed encoder frame has a big-endian 32 bit micros() timestamp after the positions
+#define TIMED_ENCODER_FRAME_SIZE 12
+
 // Register map array size in bytes
 #define REG_MAP_SIZE   6
 // Maximum length of a command
 #define MAX_SENT_BYTES 26
+// Maximum number of pixels in an UPDATE_LED_GROUP command, allowing for register, start, count and checksum
+#define MAX_GROUP_PIXELS ((MAX_SENT_BYTES - 4) / 3)
 
 // Number of neopixels
 #define NUM_LEDS 48
@@ -45,6 +62,10 @@ volatile unsigned int pos_c = 0;
 byte registerMap[REG_MAP_SIZE];
 byte receivedCommands[MAX_SENT_BYTES];
 volatile boolean newDataAvailable = false;
+// Register selected for the next version 2 read request, 0 if none
+volatile uint8_t selectedRegister = 0;
+// Incremented for every version 2 frame sent, lets the master spot frames it didn't ask for
+uint8_t frameSequence = 0;
 
 #ifdef ENABLE_MOTOR_FUNCTIONS
 // Motor drivers, must be configured in packet serial mode with addresses 128, 129 and 130
@@ -101,6 +122,7 @@ void loop() {
     uint8_t i2c_command = receivedCommands[0];
     switch (i2c_command) {
       case MOTOR_SPEED_SET:
+      case DRIVE_AND_SAMPLE:
 #ifdef ENABLE_MOTOR_FUNCTIONS
         if (checkCommand(3)) {
           for (int i = 1; i < MAX_SENT_BYTES; i++) {
@@ -130,14 +152,19 @@ void loop() {
         encoderIndex = 0;
         break;
       case UPDATE_LED_GROUP:
-        if (checkCommand(26)) {
-          int pixelOffset = 0;
-          for (int pixel = receivedCommands[1]; pixel < (receivedCommands[1] + receivedCommands[2]); pixel++) {
-            int hue = receivedCommands[3 + pixelOffset * 3];
-            int sat = receivedCommands[4 + pixelOffset * 3];
-            int val = receivedCommands[5 + pixelOffset * 3];
+        // Start pixel, pixel count, then hue, saturation and value for each pixel
+        if (receivedCommands[2] <= MAX_GROUP_PIXELS && checkCommand(2 + receivedCommands[2] * 3)) {
+          for (int pixelOffset = 0; pixelOffset < receivedCommands[2]; pixelOffset++) {
+            int pixel = receivedCommands[1] + pixelOffset;
+            if (pixel < NUM_LEDS) {
+              leds[pixel] = CHSV(receivedCommands[3 + pixelOffset * 3],
+                                 receivedCommands[4 + pixelOffset * 3],
+                                 receivedCommands[5 + pixelOffset * 3]);
+            }
           }
+          FastLED.show();
         }
+        break;
       default:
 #ifdef ENABLE_MOTOR_FUNCTIONS
         // Unknown command, stop the motors.
@@ -155,12 +182,57 @@ void loop() {
 
 // Called on I2C data request
 void requestEvent() {
-  if (encoderIndex < 6) {
-    Wire.write(encoderData[encoderIndex++]);
+  uint8_t reg = selectedRegister;
+  selectedRegister = 0;
+  switch (reg) {
+    case PROTOCOL_VERSION_READ:
+      Wire.write(PROTOCOL_VERSION);
+      break;
+    case ENCODER_READ_BLOCK:
+      writeEncoderFrame(ENCODER_READ_BLOCK, false);
+      break;
+    case DRIVE_AND_SAMPLE:
+      writeEncoderFrame(DRIVE_AND_SAMPLE, true);
+      break;
+    default:
+      // Version 1 read, one byte per request from the buffer filled by ENCODER_READ
+      if (encoderIndex < 6) {
+        Wire.write(encoderData[encoderIndex++]);
+      }
+      else {
+        Wire.write(0);
+      }
+      break;
   }
-  else {
-    Wire.write(0);
+}
+
+// Write the current encoder positions as a single frame, optionally with a timestamp. This is only called from
+// requestEvent, which runs inside the I2C interrupt handler, so the encoder interrupts can't update the positions
+// half way through.
+void writeEncoderFrame(uint8_t reg, boolean withTime) {
+  uint8_t frame[TIMED_ENCODER_FRAME_SIZE];
+  uint8_t frameSize = withTime ? TIMED_ENCODER_FRAME_SIZE : ENCODER_FRAME_SIZE;
+  int i = 0;
+  frame[i++] = (pos_c & 0xff00) >> 8;
+  frame[i++] = pos_c & 0xff;
+  frame[i++] = (pos_b & 0xff00) >> 8;
+  frame[i++] = pos_b & 0xff;
+  frame[i++] = (pos_a & 0xff00) >> 8;
+  frame[i++] = pos_a & 0xff;
+  if (withTime) {
+    unsigned long now = micros();
+    frame[i++] = (now >> 24) & 0xff;
+    frame[i++] = (now >> 16) & 0xff;
+    frame[i++] = (now >> 8) & 0xff;
+    frame[i++] = now & 0xff;
   }
+  frame[i++] = frameSequence++;
+  uint8_t checksum = reg;
+  for (int j = 0; j < frameSize - 1; j++) {
+    checksum ^= frame[j];
+  }
+  frame[i] = checksum;
+  Wire.write(frame, frameSize);
 }
 
 // Validate a command with x bytes plus a register, implying a checksum byte at recievedCommands[x+1]
@@ -174,6 +246,11 @@ boolean checkCommand(uint8_t command_length) {
 
 // Called on I2C data reception
 void receiveEvent(int bytesReceived) {
+  if (bytesReceived == 1) {
+    // Register select for a version 2 read, answered by requestEvent
+    selectedRegister = Wire.read();
+    return;
+  }
   for (int a = 0; a < bytesReceived; a++) {
     if (a < MAX_SENT_BYTES) {
       receivedCommands[a] = Wire.read();
@@ -182,6 +259,10 @@ void receiveEvent(int bytesReceived) {
       Wire.read();  // if we receive more data then allowed just throw it away
     }
   }
+  if (receivedCommands[0] == DRIVE_AND_SAMPLE) {
+    // Motor speeds are set in the main loop, but the following read request is for the encoder frame
+    selectedRegister = DRIVE_AND_SAMPLE;
+  }
   newDataAvailable = true;
 }
 
@@ -20,6 +20,7 @@ setup(
     packages=['triangula'],
     install_requires=['approxeng.input', 'approxeng.task', 'pyserial',
                       'approxeng.holochassis', 'approxeng.hwsupport', 'smbus2', 'euclid'],
+    extras_require={'analysis': ['numpy']},
     include_package_data=True,
     dependency_links=[],
     zip_safe=False)
@@ -0,0 +1,60 @@
+from math import sin, cos, degrees
+
+import pytest
+
+pytest.importorskip('approxeng.chassis')
+pytest.importorskip('euclid')
+
+from approxeng.chassis import Pose
+from euclid import Point2
+
+from triangula.fusion import FusedPoseEstimator
+
+
+class ScriptedDeadReckoning:
+    """
+    Stands in for DeadReckoning, moving to a set pose on each update
+    """
+
+    def __init__(self):
+        self.poses = []
+        self.pose = Pose(position=Point2(0, 0), orientation=0)
+
+    def reset(self):
+        self.pose = Pose(position=Point2(0, 0), orientation=0)
+
+    def update_from_counts(self, counts):
+        x, y, orientation = self.poses.pop(0)
+        self.pose = Pose(position=Point2(x, y), orientation=orientation)
+
+
+def test_translation_follows_fused_heading_clockwise():
+    dead_reckoning = ScriptedDeadReckoning()
+    estimator = FusedPoseEstimator(dead_reckoning=dead_reckoning)
+    # Fused heading half a radian clockwise of odometry's, then drive forwards
+    estimator.orientation = 0.5
+    dead_reckoning.poses.append((0, 285, 0))
+    estimator.update_from_counts([0, 0, 0])
+    assert estimator.x == pytest.approx(285 * sin(0.5))
+    assert estimator.y == pytest.approx(285 * cos(0.5))
+    assert estimator.orientation == pytest.approx(0.5)
+
+
+def test_bias_only_learned_over_stationary_intervals():
+    dead_reckoning = ScriptedDeadReckoning()
+    estimator = FusedPoseEstimator(dead_reckoning=dead_reckoning, gyro_sign=1.0, bias_time_constant=1.0)
+    dead_reckoning.poses.extend([(0, 0, 0)] * 3)
+    estimator.update_from_counts([0, 0, 0])
+
+    # Still, the gyro reads its bias of 0.1 rad/s
+    for i in range(11):
+        estimator.update_gyro(degrees(0.1), i * 0.01)
+    estimator.update_from_counts([0, 0, 0])
+    assert estimator.gyro_bias == pytest.approx(0.1 * 0.1 / 1.1)
+    learned = estimator.gyro_bias
+
+    # Starts turning straight after a stationary interval, which mustn't be taken as bias
+    for i in range(11, 21):
+        estimator.update_gyro(degrees(1.0), i * 0.01)
+    estimator.update_from_counts([10, 10, 10])
+    assert estimator.gyro_bias == learned
@@ -0,0 +1,74 @@
+import pytest
+
+pytest.importorskip('approxeng.hwsupport')
+
+from triangula.hardware import RetryPolicy
+from triangula.simulation import SimulatedHardware
+
+
+def test_solid_colour_resent_after_motor_write():
+    hardware = SimulatedHardware()
+    arduino = hardware.create_arduino()
+    # Setting up the LED in the constructor has already made writes
+    skipped = arduino.stats.skipped
+    arduino.led0 = 'teal'
+    colour = hardware.arduino.pixels[-1]
+    assert hardware.arduino.pixels == [colour] * 48
+    # The firmware shows wheel speeds on the pylons whenever it receives motor powers
+    arduino.set_motor_power(0, 0, 0)
+    assert hardware.arduino.pixels[:24] != [colour] * 24
+    arduino.led0 = 'teal'
+    assert hardware.arduino.pixels == [colour] * 48
+    assert arduino.stats.skipped == skipped
+
+
+def test_failed_pixel_group_retried_on_next_flush():
+    hardware = SimulatedHardware()
+    arduino = hardware.create_arduino()
+    hardware.i2c.error_rate = 1.0
+    assert arduino.set_pixels(30, [(0.5, 1.0, 1.0)] * 2)
+    assert arduino.stats.give_ups == 1
+    hardware.i2c.error_rate = 0.0
+    arduino.flush_pixels()
+    assert hardware.arduino.pixels[30] == hardware.arduino.pixels[31] == (127, 255, 255)
+
+
+def test_drive_and_sample_retries_and_tolerates_failure():
+    hardware = SimulatedHardware()
+    arduino = hardware.create_arduino(retry_policy=RetryPolicy(deadline=1.0))
+    writes = arduino.stats.writes
+    first = arduino.drive_and_sample(0.5, 0, -0.5)
+    assert first is not None
+    assert hardware.arduino.motor_values == [-64, 0, 64]
+    assert arduino.stats.writes == writes + 1
+
+    # Every attempt fails, so the policy gives up and the previous sample is returned rather than raising
+    hardware.i2c.error_rate = 1.0
+    assert arduino.drive_and_sample(0.2, 0.2, 0.2) is first
+    assert arduino.stats.nacks == arduino.retry_policy.max_attempts
+    assert arduino.stats.give_ups == 1
+
+    hardware.i2c.error_rate = 0.0
+    second = arduino.drive_and_sample(0.2, 0.2, 0.2)
+    assert second.timestamp > first.timestamp
+    assert arduino.stats.writes == writes + 2
+
+
+def test_stop_stops_motors():
+    hardware = SimulatedHardware()
+    arduino = hardware.create_arduino()
+    arduino.set_motor_power(0.5, 0.5, 0.5)
+    arduino.stop()
+    assert hardware.arduino.motor_values == [0, 0, 0]
+
+
+def test_lcd_same_text_not_resent_until_cleared():
+    hardware = SimulatedHardware()
+    lcd = hardware.create_lcd()
+    lcd.text = ['hello', 'world']
+    written = hardware.display.bytes_written
+    lcd.text = ['hello', 'world']
+    assert hardware.display.bytes_written == written
+    lcd.clear()
+    lcd.text = ['hello', 'world']
+    assert hardware.display.rows == ['hello'.ljust(16), 'world'.ljust(16)]
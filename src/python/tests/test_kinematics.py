@@ -0,0 +1,38 @@
+from math import cos, sin
+from random import Random
+
+import pytest
+
+from triangula.kinematics import ChassisKinematics
+
+
+def test_powers_scaled_together_when_saturated():
+    kinematics = ChassisKinematics(matrix=[[1, 0, 0], [0, 2, 0], [0, 0, 4]], max_speeds=[1, 1, 2])
+    out = [0.0, 0.0, 0.0]
+    assert kinematics.powers(0.5, 0.25, 0.1, out) == pytest.approx([0.5, 0.5, 0.2])
+    # Wheel b would need 4x full power, so everything is scaled down by 4
+    assert kinematics.powers(1.0, 2.0, 0.5, out) == pytest.approx([0.25, 1.0, 0.25])
+    assert kinematics.powers(-1.0, -2.0, -0.5, out) == pytest.approx([-0.25, -1.0, -0.25])
+
+
+def test_matches_chassis():
+    chassis_module = pytest.importorskip('approxeng.chassis')
+    from approxeng.chassis.util import get_regular_triangular_chassis
+    from euclid import Vector2
+
+    chassis = get_regular_triangular_chassis(wheel_distance=290, wheel_radius=60, max_rotations_per_second=1.0)
+    kinematics = ChassisKinematics(chassis=chassis)
+    # Random motions up to twice the chassis maximum speeds, so the saturation scaling is exercised
+    random = Random(0)
+    max_trn = chassis.get_max_translation_speed() * 2
+    max_rot = chassis.get_max_rotation_speed() * 2
+    out = [0.0, 0.0, 0.0]
+    for _ in range(1000):
+        angle = random.uniform(-3.2, 3.2)
+        speed = random.uniform(0, max_trn)
+        vx, vy, rotation = speed * cos(angle), speed * sin(angle), random.uniform(-max_rot, max_rot)
+        kinematics.powers(vx, vy, rotation, out)
+        motion = chassis_module.Motion(translation=Vector2(vx, vy), rotation=rotation)
+        speeds = chassis.get_wheel_speeds(motion=motion).speeds
+        expected = [speeds[i] / chassis.wheels[i].maximum_rotation_per_second for i in range(3)]
+        assert out == pytest.approx(expected, abs=1e-9)
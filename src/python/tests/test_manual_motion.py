@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('approxeng.chassis')
+pytest.importorskip('approxeng.task')
+
+from approxeng.chassis.util import get_regular_triangular_chassis
+
+from triangula.manual_motion import ManualMotionTask
+from triangula.simulation import SimulatedHardware, SimulatedJoystick
+
+
+class Clock:
+
+    def __init__(self):
+        self.time = 0.0
+
+    def __call__(self):
+        return self.time
+
+
+def test_jobs_scheduled_from_initialise():
+    clock = Clock()
+    task = ManualMotionTask(clock=clock, loop_rate=100, sleep_function=lambda delay: None)
+    hardware = SimulatedHardware(clock=clock)
+    chassis = get_regular_triangular_chassis(wheel_distance=290, wheel_radius=60, max_rotations_per_second=1.0)
+    arduino = hardware.create_arduino()
+    display = hardware.create_lcd()
+    joystick = SimulatedJoystick(seed=0)
+    # Started a minute after being constructed
+    clock.time = 60.0
+    task.initialise(chassis=chassis, display=display)
+    for _ in range(10):
+        task.manual_motion(arduino=arduino, display=display, joystick=joystick, chassis=chassis)
+        clock.time += 0.01
+    for job in task.scheduler:
+        assert job.overruns == 0
+        assert job.max_jitter < 0.01
+
+
+def test_missed_deadlines_follow_timing_reset():
+    clock = Clock()
+
+    def sleep(delay):
+        clock.time += delay
+
+    task = ManualMotionTask(clock=clock, loop_rate=100, sleep_function=sleep)
+    hardware = SimulatedHardware(clock=clock)
+    chassis = get_regular_triangular_chassis(wheel_distance=290, wheel_radius=60, max_rotations_per_second=1.0)
+    world = SimpleNamespace(arduino=hardware.create_arduino(), display=hardware.create_lcd(),
+                            joystick=SimulatedJoystick(seed=0), chassis=chassis, mpu=None)
+    task.initialise(chassis=chassis, display=world.display)
+    task.tick(world)
+    # Stall for a second, missing the next hundred ticks
+    clock.time += 1.0
+    task.tick(world)
+    assert task.timing.missed_deadlines == 99
+    task.timing.reset()
+    for _ in range(5):
+        task.tick(world)
+    assert task.timing.missed_deadlines == 0
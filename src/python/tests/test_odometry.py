@@ -0,0 +1,72 @@
+from math import cos, sin, pi
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+from triangula.odometry import reconstruct_poses, unwrap_counts
+
+# Wheel matrix for a regular triangular chassis with wheels 290mm from the centre and of radius 60mm, mapping robot
+# frame velocity to wheel revolutions per second
+MATRIX = [[-sin(angle) / (2 * pi * 60), cos(angle) / (2 * pi * 60), 290 / (2 * pi * 60)]
+          for angle in [0, 2 * pi / 3, 4 * pi / 3]]
+COUNTS_PER_REVOLUTION = 3310
+
+
+def constant_motion_counts(vx, vy, rotation, duration, samples, matrix=MATRIX):
+    """
+    Raw 16 bit encoder counts sampled while the robot moves with a constant velocity in its own frame
+    """
+    times = numpy.linspace(0, duration, samples)
+    revolutions = numpy.outer(times, numpy.asarray(matrix) @ [vx, vy, rotation])
+    return numpy.round(revolutions * COUNTS_PER_REVOLUTION).astype(numpy.int64) % 65536
+
+
+def test_unwrap_counts_across_wraps():
+    raw = numpy.array([65530, 4, 20, 65500, 33000])
+    assert unwrap_counts(raw).tolist() == [0, 10, 26, -30, -32530]
+
+
+def test_straight_line_is_rotated_clockwise_by_initial_orientation():
+    counts = constant_motion_counts(0, 100, 0, duration=2, samples=20)
+    pose = reconstruct_poses(counts, matrix=MATRIX, initial_pose=(0, 0, pi / 2))[-1]
+    # Forwards along the robot's y axis, which points along world x after a quarter turn clockwise
+    assert pose[0] == pytest.approx(200, abs=0.5)
+    assert pose[1] == pytest.approx(0, abs=0.5)
+    assert pose[2] == pytest.approx(pi / 2)
+
+
+def test_constant_motion_follows_exact_arc():
+    vx, vy, rotation, duration, theta0 = 150.0, 300.0, 0.8, 3.0, 0.3
+    counts = constant_motion_counts(vx, vy, rotation, duration, samples=31)
+    pose = reconstruct_poses(counts, matrix=MATRIX, initial_pose=(10, 20, theta0))[-1]
+    # Integral of the robot frame velocity rotated clockwise by an orientation increasing at a constant rate
+    theta1 = theta0 + rotation * duration
+    x = 10 + (vx * (sin(theta1) - sin(theta0)) + vy * (cos(theta0) - cos(theta1))) / rotation
+    y = 20 + (vx * (cos(theta1) - cos(theta0)) + vy * (sin(theta1) - sin(theta0))) / rotation
+    assert pose[0] == pytest.approx(x, abs=0.5)
+    assert pose[1] == pytest.approx(y, abs=0.5)
+    assert pose[2] == pytest.approx(theta1, abs=1e-3)
+
+
+def test_matches_dead_reckoning():
+    chassis_module = pytest.importorskip('approxeng.chassis')
+    from approxeng.chassis.util import get_regular_triangular_chassis
+    from euclid import Vector2
+
+    chassis = get_regular_triangular_chassis(wheel_distance=290, wheel_radius=60, max_rotations_per_second=1.0)
+    motion = chassis_module.Motion(translation=Vector2(200, 350), rotation=0.9)
+    wheel_speeds = chassis.get_wheel_speeds(motion=motion)
+    speeds = [speed / wheel_speeds.scaling for speed in wheel_speeds.speeds]
+    times = numpy.linspace(0, 4, 41)
+    counts = numpy.round(numpy.outer(times, speeds) * COUNTS_PER_REVOLUTION).astype(numpy.int64) % 65536
+
+    dead_reckoning = chassis_module.DeadReckoning(chassis=chassis, counts_per_revolution=COUNTS_PER_REVOLUTION)
+    for row in counts.tolist():
+        dead_reckoning.update_from_counts(row)
+    expected = dead_reckoning.pose
+
+    pose = reconstruct_poses(counts, chassis=chassis, counts_per_revolution=COUNTS_PER_REVOLUTION)[-1]
+    assert pose[0] == pytest.approx(expected.position.x, abs=1.0)
+    assert pose[1] == pytest.approx(expected.position.y, abs=1.0)
+    assert pose[2] == pytest.approx(expected.orientation, abs=1e-3)
@@ -0,0 +1,32 @@
+import os
+from threading import Thread
+
+from triangula.telemetry import HEADER, RECORD, FLAG_POWER, TelemetryRecorder
+
+
+def test_values_set_from_another_thread_while_committing(tmp_path):
+    filename = str(tmp_path / 'run.tlm')
+    recorder = TelemetryRecorder(filename, block_records=16, buffers=1024)
+    commits = 2000
+
+    def drive():
+        # As a driver on a worker thread would
+        for i in range(commits):
+            recorder.set_power(0.5, -0.5, 0.25)
+            recorder.set_encoders([i & 0xFFFF, 0, 0], timestamp=i)
+
+    worker = Thread(target=drive)
+    worker.start()
+    for i in range(commits):
+        recorder.commit(t=i)
+    worker.join()
+    recorder.set_power(0.0, 0.0, 0.0)
+    recorder.commit(t=commits)
+    recorder.close()
+    assert recorder.records + recorder.dropped == commits + 1
+    assert os.path.getsize(filename) == HEADER.size + recorder.records * RECORD.size
+    with open(filename, 'rb') as f:
+        f.seek(HEADER.size + (recorder.records - 1) * RECORD.size)
+        last = RECORD.unpack(f.read(RECORD.size))
+    assert last[0] == commits
+    assert last[5] & FLAG_POWER
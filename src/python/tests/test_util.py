@@ -0,0 +1,23 @@
+from triangula.util import Scheduler
+
+
+def test_late_job_runs_once_and_counts_overruns():
+    scheduler = Scheduler(clock=lambda: 0.0)
+    job = scheduler.add('job', interval=0.1)
+    # Five whole intervals late, where 0.5 // 0.1 rounds down to 4 in floating point
+    assert scheduler.due(0.5) == {'job'}
+    assert job.overruns == 5
+    assert job.deadline > 0.5
+    assert scheduler.due(0.5) == set()
+    assert scheduler.due(job.deadline) == {'job'}
+    assert job.overruns == 5
+
+
+def test_reset_starts_jobs_from_now():
+    scheduler = Scheduler(clock=lambda: 0.0)
+    job = scheduler.add('job', interval=0.1)
+    scheduler.reset(60.0)
+    assert scheduler.due(60.0) == {'job'}
+    assert job.overruns == 0
+    assert job.max_jitter == 0.0
+    assert job.deadline == 60.1
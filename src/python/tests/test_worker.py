@@ -0,0 +1,31 @@
+import pytest
+
+pytest.importorskip('approxeng.hwsupport')
+
+from triangula.simulation import SimulatedHardware
+from triangula.worker import IOWorker, ThreadedArduino
+
+
+def test_threaded_drive_and_sample():
+    hardware = SimulatedHardware()
+    worker = IOWorker()
+    worker.start()
+    arduino = ThreadedArduino(arduino=hardware.create_arduino(), worker=worker, encoder_interval=1.0)
+    arduino.drive_and_sample(0.5, 0, -0.5)
+    # Stopping runs any commands still waiting
+    worker.stop()
+    sample = arduino.drive_and_sample(0, 0, 0)
+    assert sample is not None
+    assert len(sample.counts) == 3
+    assert hardware.arduino.motor_values == [-64, 0, 64]
+
+
+def test_threaded_stop_stops_motors():
+    hardware = SimulatedHardware()
+    worker = IOWorker()
+    worker.start()
+    arduino = ThreadedArduino(arduino=hardware.create_arduino(), worker=worker, encoder_interval=1.0)
+    arduino.set_motor_power(0.5, 0.5, 0.5)
+    arduino.stop()
+    worker.stop()
+    assert hardware.arduino.motor_values == [0, 0, 0]
@@ -0,0 +1,303 @@
+"""
+Benchmarks for the control path, run against the simulated hardware in :mod:`triangula.simulation` so they can be run
+anywhere. The simulated bus can be given a per-transaction latency and per-byte transfer time; with the defaults of
+zero the benchmarks measure the host-side cost of the drivers and tasks, with realistic values (--bus-speed 100000)
+they show the effect of changes to the number and size of bus transactions.
+
+Results are written as JSON, and can be compared against a previous run::
+
+    python -m triangula.benchmark --output baseline.json
+    ... make changes ...
+    python -m triangula.benchmark --output new.json --compare baseline.json
+"""
+import argparse
+import gc
+import json
+import platform
+import sys
+import tracemalloc
+from datetime import datetime
+from time import perf_counter
+
+from triangula.simulation import SimulatedHardware, SimulatedJoystick
+from triangula.util import RollingStats
+
+
+def _latency_results(stats: RollingStats, elapsed: float) -> dict:
+    summary = stats.summary()
+    return {'ops_per_second': summary['count'] / elapsed if elapsed else 0.0,
+            'p50_us': summary['p50'] * 1e6,
+            'p99_us': summary['p99'] * 1e6,
+            'max_us': summary['max'] * 1e6}
+
+
+def _time_calls(function, iterations: int) -> dict:
+    """
+    Call a function repeatedly, returning the call rate and latency percentiles
+    """
+    stats = RollingStats(iterations)
+    start = perf_counter()
+    for _ in range(iterations):
+        call_start = perf_counter()
+        function()
+        stats.add(perf_counter() - call_start)
+    return _latency_results(stats, perf_counter() - start)
+
+
+def _allocation_results(function, iterations: int) -> dict:
+    """
+    Call a function repeatedly under tracemalloc, returning the memory allocated within each call and not freed by the
+    end of it, the memory retained across all calls, and the number of garbage collections triggered. Transient
+    allocations are measured as the peak traced memory within each call, so are a lower bound where a call allocates
+    and frees several objects in turn. Any allocation at all within a tick shows up here.
+    """
+    collections_start = sum(stats['collections'] for stats in gc.get_stats())
+    tracemalloc.start()
+    try:
+        start, _ = tracemalloc.get_traced_memory()
+        transient = 0
+        allocating_calls = 0
+        for _ in range(iterations):
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            function()
+            _, peak = tracemalloc.get_traced_memory()
+            transient += peak - before
+            if peak > before:
+                allocating_calls += 1
+        end, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'allocated_bytes_per_call': transient / iterations,
+            'allocating_call_fraction': allocating_calls / iterations,
+            'retained_bytes_per_call': (end - start) / iterations,
+            'gc_collections': sum(stats['collections'] for stats in gc.get_stats()) - collections_start}
+
+
+def benchmark_motor_power(hardware: SimulatedHardware, iterations: int) -> dict:
+    """
+    Throughput of Arduino.set_motor_power with varying powers
+    """
+    arduino = hardware.create_arduino()
+    powers = [i / iterations * 2 - 1 for i in range(iterations)]
+    index = iter(range(iterations))
+
+    def call():
+        p = powers[next(index)]
+        arduino.set_motor_power(p, -p, p * 0.5)
+
+    bus_start = hardware.i2c.transactions
+    results = _time_calls(call, iterations)
+    results['transactions_per_call'] = (hardware.i2c.transactions - bus_start) / iterations
+    results['skipped_fraction'] = arduino.stats.skipped / iterations
+    # Allocations when actually sending, which includes whatever the bus allocates per transaction, here the simulated
+    # bus and Arduino, on the robot smbus2
+    arduino.refresh_interval = 0
+    results.update(_allocation_results(lambda: arduino.set_motor_power(0.5, -0.5, 0.25), iterations))
+    return results
+
+
+def benchmark_encoder_values(hardware: SimulatedHardware, iterations: int) -> dict:
+    """
+    Latency of Arduino.encoder_values
+    """
+    arduino = hardware.create_arduino()
+    bus_start = hardware.i2c.transactions
+    results = _time_calls(lambda: arduino.encoder_values, iterations)
+    results['transactions_per_call'] = (hardware.i2c.transactions - bus_start) / iterations
+    return results
+
+
+def benchmark_mpu(hardware: SimulatedHardware, iterations: int) -> dict:
+    """
+    IMU sample rate, reading acceleration, temperature and gyro together
+    """
+    mpu = hardware.create_mpu()
+    bus_start = hardware.i2c.transactions
+    results = _time_calls(mpu.read_frame, iterations)
+    results['transactions_per_call'] = (hardware.i2c.transactions - bus_start) / iterations
+    return results
+
+
+def benchmark_lcd(hardware: SimulatedHardware, iterations: int) -> dict:
+    """
+    Cost of updating the LCD with a pose readout where a few digits change each time
+    """
+    lcd = hardware.create_lcd()
+    counter = iter(range(iterations))
+
+    def call():
+        i = next(counter)
+        lcd.text = ['x:{:7.0f}, b:{:3.0f}'.format(i * 3, i % 360), 'y:{:7.0f}, REL'.format(i * 2)]
+
+    bytes_start = hardware.display.bytes_written
+    busy_start = hardware.display.busy_time
+    results = _time_calls(call, iterations)
+    results['bytes_per_update'] = (hardware.display.bytes_written - bytes_start) / iterations
+    # Time the updates would keep the serial line busy at the configured baud rate
+    results['serial_ms_per_update'] = (hardware.display.busy_time - busy_start) / iterations * 1000
+    return results
+
+
+def benchmark_manual_motion(hardware: SimulatedHardware, iterations: int) -> dict:
+    """
+    Time for a complete tick of ManualMotionTask.manual_motion, with joystick input sweeping smoothly around. The task
+    and the simulated Arduino share a clock advanced by 10ms on each tick, so the scheduled pose and display updates
+    and the input filter see time pass as they would at 100 ticks per second. The Arduino driver's keep-alive refresh
+    of unchanged motor powers runs on the real clock, so doesn't happen within the benchmark.
+
+    Allocations are measured with the joystick still. The task and drivers build no objects of their own on a tick
+    which only skips unchanged motor powers, but some allocation remains which can't be avoided from here:
+
+    * Floats, and ints outside the small int cache, are objects, so the clock, input and power arithmetic allocates a
+      few tens of bytes on most ticks
+    * On pose updates DeadReckoning.update_from_counts, in approxeng.chassis, builds a list of wheel speeds, a Motion
+      with a euclid Vector2, and a new Pose, around 600 bytes each time
+    * Each bus transaction allocates within the bus, here the simulated I2C bus and Arduino, on the robot the ctypes
+      structures and result lists of smbus2, and the 'with' statement around it allocates bound methods
+    * Encoder reads return a new list of counts, as DeadReckoning keeps the list it's given
+    """
+    from approxeng.chassis.util import get_regular_triangular_chassis
+    from triangula.manual_motion import ManualMotionTask
+    from triangula.replay import ReplayClock
+
+    clock = ReplayClock(0.0)
+    hardware = SimulatedHardware(clock=clock, latency=hardware.i2c.latency, byte_time=hardware.i2c.byte_time,
+                                 motor_time_constant=hardware.arduino.motor_time_constant)
+    chassis = get_regular_triangular_chassis(wheel_distance=290, wheel_radius=60, max_rotations_per_second=1.0)
+    arduino = hardware.create_arduino()
+    lcd = hardware.create_lcd()
+    joystick = SimulatedJoystick(seed=0)
+    task = ManualMotionTask(clock=clock)
+    task.initialise(chassis=chassis, display=lcd)
+    stats = RollingStats(iterations)
+    bus_start = hardware.i2c.transactions
+    skipped_start = arduino.stats.skipped
+    start = perf_counter()
+    for i in range(iterations):
+        clock.time = i * 0.01
+        joystick.update(clock.time)
+        tick_start = perf_counter()
+        task.manual_motion(arduino=arduino, display=lcd, joystick=joystick, chassis=chassis)
+        stats.add(perf_counter() - tick_start)
+    results = _latency_results(stats, perf_counter() - start)
+    results['transactions_per_tick'] = (hardware.i2c.transactions - bus_start) / iterations
+    results['skipped_motor_write_fraction'] = (arduino.stats.skipped - skipped_start) / iterations
+
+    # Allocations within the tick itself, with the joystick holding still so only the task and drivers are measured,
+    # and the clock still advancing so the scheduled updates are included
+    def tick():
+        clock.time += 0.01
+        task.manual_motion(arduino=arduino, display=lcd, joystick=joystick, chassis=chassis)
+
+    allocations = _allocation_results(tick, iterations)
+    results.update({key.replace('call', 'tick'): value for key, value in allocations.items()})
+    return results
+
+
+def benchmark_kinematics(hardware: SimulatedHardware, iterations: int) -> dict:
+    """
+    Cost of the precomputed kinematics fast path against HoloChassis.get_wheel_speeds for the same motion
+    """
+    from approxeng.chassis import Motion
+    from approxeng.chassis.util import get_regular_triangular_chassis
+    from euclid import Vector2
+    from triangula.kinematics import ChassisKinematics
+
+    chassis = get_regular_triangular_chassis(wheel_distance=290, wheel_radius=60, max_rotations_per_second=1.0)
+    kinematics = ChassisKinematics(chassis=chassis)
+    out = [0.0, 0.0, 0.0]
+    results = _time_calls(lambda: kinematics.powers(120.0, -80.0, 0.5, out), iterations)
+    chassis_results = _time_calls(
+        lambda: chassis.get_wheel_speeds(motion=Motion(translation=Vector2(120.0, -80.0), rotation=0.5)), iterations)
+    results['chassis_p50_us'] = chassis_results['p50_us']
+    return results
+
+
+#: All benchmarks, by name
+BENCHMARKS = {'motor_power': benchmark_motor_power,
+              'encoder_values': benchmark_encoder_values,
+              'mpu_frame': benchmark_mpu,
+              'lcd_update': benchmark_lcd,
+              'kinematics': benchmark_kinematics,
+              'manual_motion_tick': benchmark_manual_motion}
+
+
+def run_benchmarks(names=None, iterations=2000, latency=0.0, byte_time=0.0) -> dict:
+    """
+    Run benchmarks, each against a freshly created set of simulated hardware
+
+    :param names:
+        Names of benchmarks to run, defaults to all of them
+    :param int iterations:
+        Number of calls or ticks in each benchmark
+    :param float latency:
+        Simulated time in seconds for each I2C transaction
+    :param float byte_time:
+        Simulated time in seconds for each byte transferred over I2C
+    :return:
+        A dict containing the run parameters, and the results of each benchmark
+    """
+    results = {}
+    for name in names or BENCHMARKS:
+        hardware = SimulatedHardware(latency=latency, byte_time=byte_time, motor_time_constant=0)
+        try:
+            results[name] = BENCHMARKS[name](hardware, iterations)
+        except ImportError as e:
+            # The motion benchmark needs the full set of approxeng libraries
+            results[name] = {'skipped': str(e)}
+    return {'meta': {'time': datetime.now().isoformat(),
+                     'python': sys.version.split()[0],
+                     'platform': platform.platform(),
+                     'machine': platform.machine(),
+                     'iterations': iterations,
+                     'latency': latency,
+                     'byte_time': byte_time},
+            'results': results}
+
+
+def compare(baseline: dict, current: dict) -> str:
+    """
+    Format a table comparing each metric in two sets of results, with the ratio of current to baseline values
+    """
+    lines = [f'{"benchmark":<20} {"metric":<24} {"baseline":>12} {"current":>12} {"ratio":>8}']
+    for name, metrics in current['results'].items():
+        for metric, value in metrics.items():
+            old = baseline['results'].get(name, {}).get(metric)
+            if not isinstance(value, (int, float)) or not isinstance(old, (int, float)):
+                continue
+            ratio = f'{value / old:8.2f}' if old else f'{"-":>8}'
+            lines.append(f'{name:<20} {metric:<24} {old:12.2f} {value:12.2f} {ratio}')
+    return '\n'.join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Triangula control path against simulated hardware')
+    parser.add_argument('benchmarks', nargs='*', help=f'benchmarks to run from {list(BENCHMARKS)}, defaults to all')
+    parser.add_argument('--iterations', type=int, default=2000, help='calls or ticks per benchmark')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated seconds per I2C transaction')
+    parser.add_argument('--bus-speed', type=float, default=0,
+                        help='simulated I2C clock in Hz, 0 for instantaneous transfers')
+    parser.add_argument('--output', help='file to write JSON results to')
+    parser.add_argument('--compare', help='JSON results from a previous run to compare against')
+    options = parser.parse_args(args)
+    for name in options.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f'unknown benchmark {name}')
+
+    # Nine clock cycles per byte including the acknowledge bit
+    byte_time = 9 / options.bus_speed if options.bus_speed else 0.0
+    results = run_benchmarks(names=options.benchmarks, iterations=options.iterations, latency=options.latency,
+                             byte_time=byte_time)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if options.compare:
+        with open(options.compare) as f:
+            print(compare(json.load(f), results))
+    else:
+        print(json.dumps(results['results'], indent=2))
+
+
+if __name__ == '__main__':
+    main()
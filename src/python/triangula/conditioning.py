@@ -0,0 +1,106 @@
+"""
+Conditioning of analogue stick input before it's used to drive the robot. Raw stick values wander by a percent or
+two even when the sticks are held still, and feeding these straight into the motion calculations means every tick
+produces a slightly different set of motor powers, each of which has to be sent over the bus.
+:class:`InputConditioner` applies, per axis:
+
+* a deadband, so a centred stick reads as exactly zero, with the remaining travel rescaled to the full range
+* an expo curve, for finer control around the centre while still reaching full speed at the ends
+* a first order low pass filter, to smooth out noise and sudden jerks
+* change threshold suppression, so the output only moves when the filtered value has moved far enough to matter
+
+With the sticks held steady the output stays exactly the same from tick to tick, so the motion task calculates the
+same motor powers and the Arduino driver can skip sending them again.
+"""
+
+
+class InputConditioner:
+    """
+    Conditions a fixed number of axes, each in the range -1.0 to 1.0
+    """
+
+    __slots__ = ['deadband', 'expo', 'time_constant', 'change_threshold', 'values', '_filtered', '_last_time']
+
+    def __init__(self, axes: int = 3, deadband: float = 0.02, expo: float = 0.0, time_constant: float = 0.05,
+                 change_threshold: float = 0.01):
+        """
+        Constructor
+
+        :param int axes:
+            Number of axes
+        :param float deadband:
+            Inputs with magnitude below this are treated as zero
+        :param float expo:
+            Blend between a linear response at 0.0 and a cubic one at 1.0
+        :param float time_constant:
+            Time constant of the low pass filter in seconds, 0 to disable filtering
+        :param float change_threshold:
+            Smallest change in filtered value which changes the output, 0 to pass every change through
+        """
+        self.deadband = deadband
+        self.expo = expo
+        self.time_constant = time_constant
+        self.change_threshold = change_threshold
+        #: Conditioned value of each axis
+        self.values = [0.0] * axes
+        self._filtered = [0.0] * axes
+        self._last_time = None
+
+    def reset(self):
+        """
+        Set all axes back to zero
+        """
+        for i in range(len(self.values)):
+            self.values[i] = 0.0
+            self._filtered[i] = 0.0
+        self._last_time = None
+
+    def shape(self, value: float) -> float:
+        """
+        Apply deadband and expo curve to a single raw value
+        """
+        magnitude = abs(value)
+        if magnitude <= self.deadband:
+            return 0.0
+        # Called for every axis on every tick, and min() allocates a tuple for its arguments
+        magnitude = (magnitude - self.deadband) / (1.0 - self.deadband)
+        if magnitude > 1.0:
+            magnitude = 1.0
+        magnitude = (1.0 - self.expo) * magnitude + self.expo * magnitude * magnitude * magnitude
+        return magnitude if value > 0 else -magnitude
+
+    def update(self, raw, now: float) -> bool:
+        """
+        Update the conditioned values from raw axis values
+
+        :param raw:
+            Sequence of raw values, one per axis
+        :param float now:
+            Current time in seconds
+        :return:
+            True if any of the conditioned values changed
+        """
+        if self._last_time is None or self.time_constant <= 0:
+            alpha = 1.0
+        else:
+            dt = now - self._last_time
+            alpha = dt / (self.time_constant + dt) if dt > 0 else 0.0
+        self._last_time = now
+        values = self.values
+        filtered = self._filtered
+        threshold = self.change_threshold
+        changed = False
+        # Called on every tick, so step through the axes with an index rather than allocating a range and iterator
+        i = 0
+        while i < len(values):
+            target = self.shape(raw[i])
+            f = filtered[i] + alpha * (target - filtered[i])
+            # Settle exactly on zero and full scale rather than approaching them forever
+            if abs(target - f) < threshold and (target == 0.0 or abs(target) == 1.0):
+                f = target
+            filtered[i] = f
+            if f != values[i] and (abs(f - values[i]) >= threshold or f == target):
+                values[i] = f
+                changed = True
+            i += 1
+        return changed
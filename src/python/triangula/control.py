@@ -0,0 +1,150 @@
+"""
+Closed loop wheel speed control. The motion task normally drives the motors open loop, sending each wheel a power
+proportional to the speed it should be turning at, which undershoots whenever the wheels are loaded, on carpet or a
+slope for example, and varies with battery voltage. :class:`WheelVelocityEstimator` measures the actual wheel speeds
+from timestamped encoder counts, and :class:`PISpeedController` adjusts the powers sent to bring these to the
+requested speeds.
+"""
+from typing import List
+
+
+class WheelVelocityEstimator:
+    """
+    Estimates the speed of each wheel from successive raw encoder counts, smoothed with a first order low pass filter
+    to take out the quantisation noise from short intervals
+    """
+
+    __slots__ = ['counts_per_revolution', 'time_constant', 'speeds', '_last_counts', '_last_time', '_measured']
+
+    def __init__(self, counts_per_revolution: int = 3310, time_constant: float = 0.05, wheels: int = 3):
+        """
+        Constructor
+
+        :param int counts_per_revolution:
+            Encoder counts per wheel revolution
+        :param float time_constant:
+            Time constant of the smoothing filter in seconds, 0 to use the raw speed from each interval
+        :param int wheels:
+            Number of wheels
+        """
+        self.counts_per_revolution = counts_per_revolution
+        self.time_constant = time_constant
+        #: Estimated speed of each wheel in revolutions per second
+        self.speeds = [0.0] * wheels
+        self._last_counts = [0] * wheels
+        self._last_time = None
+        self._measured = False
+
+    def reset(self):
+        """
+        Forget previous samples and set estimated speeds to zero
+        """
+        for i in range(len(self.speeds)):
+            self.speeds[i] = 0.0
+        self._last_time = None
+        self._measured = False
+
+    @property
+    def valid(self) -> bool:
+        """
+        True if at least two samples have been seen, so speeds are measured rather than assumed
+        """
+        return self._measured
+
+    def update(self, counts, timestamp: float) -> List[float]:
+        """
+        Update speeds with a new sample
+
+        :param counts:
+            Raw unsigned 16 bit encoder counts
+        :param float timestamp:
+            Time in seconds at which the counts were read, ideally taken by the device reading the encoders
+        :return:
+            The updated speeds in revolutions per second
+        """
+        last_counts = self._last_counts
+        speeds = self.speeds
+        if self._last_time is not None:
+            dt = timestamp - self._last_time
+            if dt <= 0:
+                return speeds
+            alpha = dt / (self.time_constant + dt)
+            scale = 1.0 / (self.counts_per_revolution * dt)
+            for i in range(len(speeds)):
+                delta = ((counts[i] - last_counts[i] + 32768) & 0xFFFF) - 32768
+                speeds[i] += alpha * (delta * scale - speeds[i])
+            self._measured = True
+        for i in range(len(speeds)):
+            last_counts[i] = counts[i]
+        self._last_time = timestamp
+        return speeds
+
+
+class PISpeedController:
+    """
+    Per wheel proportional-integral speed controller with feed forward. Errors are normalised by each wheel's maximum
+    speed, so the gains are dimensionless and a proportional gain of 1.0 adds full power for an error of full speed.
+    The feed forward term is the open loop power the motion task would otherwise send, so the controller only has to
+    correct for load and the integral term starts near zero.
+    """
+
+    __slots__ = ['max_speeds', 'kp', 'ki', 'integral_limit', '_integrals', '_last_time', '_powers']
+
+    def __init__(self, max_speeds, kp: float = 0.5, ki: float = 2.0, integral_limit: float = 0.5):
+        """
+        Constructor
+
+        :param max_speeds:
+            Maximum speed of each wheel in revolutions per second, at full power
+        :param float kp:
+            Proportional gain
+        :param float ki:
+            Integral gain, per second
+        :param float integral_limit:
+            Largest magnitude of power the integral term can contribute
+        """
+        self.max_speeds = list(max_speeds)
+        self.kp = kp
+        self.ki = ki
+        self.integral_limit = integral_limit
+        self._integrals = [0.0] * len(self.max_speeds)
+        self._last_time = None
+        self._powers = [0.0] * len(self.max_speeds)
+
+    def reset(self):
+        """
+        Clear the integral terms
+        """
+        self._integrals = [0.0] * len(self.max_speeds)
+        self._last_time = None
+
+    def update(self, targets, measured, now: float) -> List[float]:
+        """
+        Calculate motor powers
+
+        :param targets:
+            Requested speed of each wheel, in revolutions per second
+        :param measured:
+            Measured speed of each wheel, in revolutions per second, or None to use feed forward alone
+        :param float now:
+            Current time in seconds
+        :return:
+            Motor powers from -1.0 to 1.0, in a list which is reused by the next call
+        """
+        dt = 0.0 if self._last_time is None else now - self._last_time
+        self._last_time = now
+        powers = self._powers
+        for i in range(len(powers)):
+            max_speed = self.max_speeds[i]
+            power = targets[i] / max_speed
+            if measured is not None:
+                error = (targets[i] - measured[i]) / max_speed
+                integral = self._integrals[i]
+                power += self.kp * error + integral
+                # Only integrate when not saturated, or when the error would pull the output back out of saturation,
+                # to avoid the integral winding up while a wheel is stalled at full power
+                if -1.0 < power < 1.0 or (power >= 1.0) != (error > 0):
+                    integral += self.ki * error * dt
+                    self._integrals[i] = max(-self.integral_limit, min(self.integral_limit, integral))
+            powers[i] = max(-1.0, min(1.0, power))
+        return powers
@@ -0,0 +1,138 @@
+"""
+Pose estimation combining wheel odometry with the MPU9150's gyro. Odometry alone gives a good estimate of heading
+while the wheels grip, but every slip turns straight into a permanent heading error, which in the motion task's
+absolute mode makes the controls drift round. The gyro measures rotation directly, and doesn't care about slip, but
+has a small bias which integrates into a slow drift of its own.
+
+:class:`FusedPoseEstimator` blends the two as a complementary filter on heading changes: over each odometry interval
+the change in heading is mostly taken from the integrated gyro, with a small share from odometry to pull back the
+gyro's drift. The gyro bias is learned from the average rate over odometry intervals in which the encoders show the
+robot standing still throughout. Translation comes from odometry, but is applied along the fused heading.
+"""
+from math import pi, radians, sin, cos
+
+from approxeng.chassis import Pose
+from euclid import Point2
+
+
+def _wrap(angle: float) -> float:
+    return (angle + pi) % (2 * pi) - pi
+
+
+class FusedPoseEstimator:
+    """
+    Wraps an approxeng.chassis DeadReckoning, presenting the same pose, reset() and update_from_counts() interface,
+    so it can be used in its place, with the addition of update_gyro() to feed in gyro samples. Gyro samples should be
+    supplied much more frequently than counts, ideally at the control loop rate.
+    """
+
+    def __init__(self, dead_reckoning, gyro_weight: float = 0.98, gyro_sign: float = -1.0,
+                 bias_time_constant: float = 2.0):
+        """
+        Constructor
+
+        :param dead_reckoning:
+            DeadReckoning which will be updated from the encoder counts
+        :param float gyro_weight:
+            Share of each heading change taken from the gyro, from 0 to 1
+        :param float gyro_sign:
+            Multiplier taking gyro z readings to the pose convention, in which orientation increases clockwise when
+            viewed from above. A positive z rate is anticlockwise about an upward pointing z axis, so this is -1.0 for
+            an IMU mounted with z up, the default, and 1.0 for one mounted with z down.
+        :param float bias_time_constant:
+            Time constant in seconds over which gyro bias is learned while stationary
+        """
+        self.dead_reckoning = dead_reckoning
+        self.gyro_weight = gyro_weight
+        self.gyro_sign = gyro_sign
+        self.bias_time_constant = bias_time_constant
+        #: Current gyro bias estimate, in radians per second
+        self.gyro_bias = 0.0
+        self.reset()
+
+    def reset(self):
+        """
+        Reset the pose to the origin, keeping the learned gyro bias
+        """
+        self.dead_reckoning.reset()
+        self.x = 0.0
+        self.y = 0.0
+        self.orientation = 0.0
+        self._gyro_heading = 0.0
+        self._gyro_heading_at_counts = 0.0
+        self._gyro_samples = 0
+        self._last_rate = None
+        self._last_gyro_time = None
+        self._last_counts = None
+        # Integrated raw gyro rate and time covered since the last odometry update, used to learn the bias if the
+        # encoders show the robot didn't move over the interval
+        self._interval_rotation = 0.0
+        self._interval_time = 0.0
+
+    @property
+    def pose(self) -> Pose:
+        """
+        Current fused pose
+        """
+        return Pose(position=Point2(self.x, self.y), orientation=self.orientation)
+
+    def update_gyro(self, rate: float, timestamp: float):
+        """
+        Integrate a gyro sample
+
+        :param float rate:
+            Rotation rate about the z axis in degrees per second, as in :class:`triangula.hardware.IMUFrame`
+        :param float timestamp:
+            Time in seconds at which the sample was read
+        """
+        rate = radians(rate) * self.gyro_sign
+        last_time = self._last_gyro_time
+        if last_time is not None:
+            dt = timestamp - last_time
+            if dt <= 0:
+                return
+            # Trapezoidal integration of bias corrected rate
+            rotation = (rate + self._last_rate) * 0.5 * dt
+            self._gyro_heading += rotation - self.gyro_bias * dt
+            self._gyro_samples += 1
+            self._interval_rotation += rotation
+            self._interval_time += dt
+        self._last_rate = rate
+        self._last_gyro_time = timestamp
+
+    def update_from_counts(self, counts):
+        """
+        Update the pose from encoder counts, as DeadReckoning.update_from_counts
+        """
+        dead_reckoning = self.dead_reckoning
+        before = dead_reckoning.pose
+        dead_reckoning.update_from_counts(counts)
+        after = dead_reckoning.pose
+
+        odometry_rotation = _wrap(after.orientation - before.orientation)
+        if self._gyro_samples:
+            gyro_rotation = self._gyro_heading - self._gyro_heading_at_counts
+            rotation = self.gyro_weight * gyro_rotation + (1 - self.gyro_weight) * odometry_rotation
+        else:
+            rotation = odometry_rotation
+        self._gyro_heading_at_counts = self._gyro_heading
+        self._gyro_samples = 0
+
+        # Odometry translation, moved from odometry's heading to the fused heading at the middle of the interval.
+        # Orientation is measured clockwise, so this is a clockwise rotation by the difference in headings.
+        offset = (self.orientation + rotation * 0.5) - (before.orientation + odometry_rotation * 0.5)
+        dx = after.position.x - before.position.x
+        dy = after.position.y - before.position.y
+        c, s = cos(offset), sin(offset)
+        self.x += c * dx + s * dy
+        self.y += c * dy - s * dx
+        self.orientation = _wrap(self.orientation + rotation)
+
+        # Only learn bias once the counts confirm the robot was still for the whole interval the samples cover
+        interval_time = self._interval_time
+        if interval_time > 0 and self._last_counts is not None and list(counts) == self._last_counts:
+            mean_rate = self._interval_rotation / interval_time
+            self.gyro_bias += (mean_rate - self.gyro_bias) * interval_time / (self.bias_time_constant + interval_time)
+        self._interval_rotation = 0.0
+        self._interval_time = 0.0
+        self._last_counts = list(counts)
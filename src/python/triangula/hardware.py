@@ -6,18 +6,226 @@ board. This isn't used anywhere in the current code, but in principle it should
 information and similar, it also has a temperature sensor.
 """
 import colorsys
+import ctypes
 import logging
-from typing import List
-from time import sleep
+import struct
+from array import array
+from threading import Lock, RLock
+from typing import List, NamedTuple, Optional, Union
+from time import sleep, monotonic
 import serial
 from approxeng.hwsupport import add_properties
-from smbus2 import SMBus
+from smbus2 import SMBus, i2c_msg
 
+from triangula.profiling import PROFILER
 from triangula.util import IntervalCheck
 
 LOG = logging.getLogger('triangula.hardware')
 
 
+class I2CBus:
+    """
+    A long-lived session on an I2C bus, shared between all the drivers attached to that bus. Opening an SMBus is an
+    open() and ioctl() on the device file, which is far more expensive than the actual transfer for the handful of bytes
+    we typically send, so rather than doing this for every call the bus is opened once and kept open until explicitly
+    closed, either by calling close() or by using the bus in a 'with' clause.
+
+    All access to the underlying SMBus goes through transaction(), which holds a re-entrant lock for the duration of
+    the enclosed block, so multiple tasks or threads can share a bus safely, and sequences of reads and writes which
+    must not be interleaved with other traffic can be grouped in a single transaction. If an IOError escapes from a
+    transaction the underlying handle is closed, and will be re-opened on the next transaction.
+    """
+
+    _shared = {}
+    _shared_lock = Lock()
+
+    class Transaction:
+        """
+        Context manager returned by transaction(). There's one per bus, reused for every transaction, so starting a
+        transaction doesn't create a new object, though the 'with' statement itself allocates bound methods for
+        __enter__ and __exit__.
+        """
+        __slots__ = ['bus']
+
+        def __init__(self, bus: 'I2CBus'):
+            self.bus = bus
+
+        def __enter__(self) -> SMBus:
+            bus = self.bus
+            bus.lock.acquire()
+            try:
+                # Only go through open(), which takes the lock again, if the bus isn't already open
+                smbus = bus._smbus
+                return smbus if smbus is not None else bus.open()
+            except BaseException:
+                bus.lock.release()
+                raise
+
+        def __exit__(self, exc_type, exc_val, exc_tb):
+            bus = self.bus
+            try:
+                if exc_type is not None and issubclass(exc_type, IOError):
+                    LOG.debug('I2C bus %s failed, closing', bus.bus_number)
+                    bus.close()
+            finally:
+                bus.lock.release()
+            return False
+
+    def __init__(self, bus: int = 1, factory=SMBus):
+        """
+        Constructor
+
+        :param int bus:
+            The I2C bus number, 1 on all recent Raspberry Pi models
+        :param factory:
+            Called with the bus number to open the underlying bus, defaults to smbus2.SMBus. Anything with the same
+            interface can be used here, such as the simulated bus in :mod:`triangula.simulation`.
+        """
+        self.bus_number = bus
+        self.factory = factory
+        self.lock = RLock()
+        self._smbus = None
+        self._transaction = I2CBus.Transaction(self)
+
+    @staticmethod
+    def shared(bus: Union[int, 'I2CBus'] = 1) -> 'I2CBus':
+        """
+        Get the shared I2CBus for a given bus number, creating it if required. If passed an existing I2CBus this
+        simply returns it, so drivers can accept either a bus number or an explicitly created bus.
+        """
+        if isinstance(bus, I2CBus):
+            return bus
+        with I2CBus._shared_lock:
+            if bus not in I2CBus._shared:
+                I2CBus._shared[bus] = I2CBus(bus)
+            return I2CBus._shared[bus]
+
+    def open(self) -> SMBus:
+        """
+        Open the underlying SMBus if it isn't already open, and return it
+        """
+        with self.lock:
+            if self._smbus is None:
+                self._smbus = self.factory(self.bus_number)
+            return self._smbus
+
+    def close(self):
+        """
+        Close the underlying SMBus. The bus can still be used after this, in which case it will be re-opened.
+        """
+        with self.lock:
+            if self._smbus is not None:
+                try:
+                    self._smbus.close()
+                finally:
+                    self._smbus = None
+
+    def transaction(self) -> 'I2CBus.Transaction':
+        """
+        Hold the bus lock, yielding an open SMBus to use within a 'with' clause. Any IOError raised within the block
+        will close the underlying handle before being passed on, to be re-opened on the next transaction.
+        """
+        return self._transaction
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class I2CWriteError(IOError):
+    """
+    Raised when a write to an I2C device still fails after exhausting its :class:`RetryPolicy`
+    """
+    pass
+
+
+class RetryPolicy:
+    """
+    Controls how hard a driver tries to complete an I2C write before giving up. Failed attempts are retried after a
+    delay which starts at backoff seconds and doubles with each retry, until either max_attempts attempts have been
+    made or the next retry would end after deadline seconds from the first attempt. The defaults keep the worst case
+    to around 10ms, which is short enough to be tolerable within a control loop tick.
+    """
+
+    def __init__(self, max_attempts: int = 3, backoff: float = 0.002, deadline: float = 0.01,
+                 raise_on_failure: bool = False):
+        """
+        Constructor
+
+        :param int max_attempts:
+            Maximum number of attempts, including the first one
+        :param float backoff:
+            Delay in seconds before the first retry, doubled for each subsequent retry
+        :param float deadline:
+            Maximum time in seconds from the first attempt to the end of the last retry delay
+        :param bool raise_on_failure:
+            If True, raise an :class:`I2CWriteError` when giving up, otherwise log a warning and carry on
+        """
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.deadline = deadline
+        self.raise_on_failure = raise_on_failure
+
+
+class I2CStats:
+    """
+    Counters for I2C writes made by a driver, can be read at any point to check on the health of the bus
+    """
+    __slots__ = ['writes', 'nacks', 'retries', 'give_ups', 'skipped']
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        Set all counters to zero
+        """
+        #: Writes which succeeded
+        self.writes = 0
+        #: Attempts which failed with an IOError, typically because the device didn't acknowledge
+        self.nacks = 0
+        #: Attempts made after a failure
+        self.retries = 0
+        #: Writes abandoned after exhausting the retry policy
+        self.give_ups = 0
+        #: Writes not made because the same data had recently been sent to the same register
+        self.skipped = 0
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f'I2CStats({self.as_dict()})'
+
+
+class IMUFrame(NamedTuple):
+    """
+    A single sample from the MPU9150, acceleration in meters per second squared, temperature in degrees Celsius, and
+    gyro rates in degrees per second, all read at the same instant
+    """
+    accel_x: float
+    accel_y: float
+    accel_z: float
+    temperature: float
+    gyro_x: float
+    gyro_y: float
+    gyro_z: float
+
+
+class EncoderSample(NamedTuple):
+    """
+    Encoder counts read from the Arduino along with the time at which they were read
+    """
+    #: Raw 16 bit counts from the three wheel encoders
+    counts: List[int]
+    #: Time in seconds at which the counts were read. This is from the Arduino's clock when it supports timed frames,
+    #: and from the host's monotonic clock otherwise, so only differences between timestamps are meaningful.
+    timestamp: float
+
+
 class MPU9150:
     """
     Attached motion processor
@@ -35,20 +243,64 @@ class MPU9150:
     ACCEL_CONFIG = 0x1C
     GYRO_CONFIG = 0x1B
 
-    def __init__(self, address=0x68, bus=1):
+    # Accelerometer, temperature and gyro output registers are contiguous from 0x3B to 0x48, so a whole sample can be
+    # read in a single block transfer. Values are big-endian signed 16 bit.
+    SENSOR_OUT = 0x3B
+    SENSOR_FRAME = struct.Struct('>7h')
+
+    # Full scale select bits within the accel and gyro config registers, the others are self-test flags
+    FULL_SCALE_MASK = 0x18
+    GRAVITIY_MS2 = 9.80665
+
+    def __init__(self, address=0x68, bus: Union[int, I2CBus] = 1):
         self._address = address
-        self._bus = bus
+        self._bus = I2CBus.shared(bus)
+        #: :class:`triangula.profiling.Profiler` to which transactions are reported
+        self.profiler = PROFILER
+        #: Optional :class:`triangula.telemetry.TelemetryRecorder` to which frames are reported
+        self.telemetry = None
+        self._accel_range = None
+        self._gyro_range = None
+        self._accel_scale = None
+        self._gyro_scale = None
 
         # Wake up the sensor
         PWR_MGMT_1 = 0x6B
-        with SMBus(self._bus) as bus:
+        with self._bus.transaction() as bus:
             bus.write_byte_data(self._address, PWR_MGMT_1, 0x00)
+        self.refresh_config()
+
+    def refresh_config(self):
+        """
+        Read the accelerometer and gyro ranges from the sensor. The ranges are cached, along with the scale factors
+        derived from them, so the sensor reads don't have to go back to the config registers every time. This is
+        called on construction, and when the ranges are set through this driver; you only need to call it if the
+        configuration has been changed by something else.
+        """
+        with self._bus.transaction() as bus:
+            accel_raw = bus.read_byte_data(self._address, self.ACCEL_CONFIG) & self.FULL_SCALE_MASK
+            gyro_raw = bus.read_byte_data(self._address, self.GYRO_CONFIG) & self.FULL_SCALE_MASK
+        self._set_accel_range(next(g for g, raw in self.ACCEL_RANGES.items() if raw == accel_raw))
+        self._set_gyro_range(next(t for t, raw in self.GYRO_RANGES.items() if raw == gyro_raw))
+
+    def _set_accel_range(self, g):
+        self._accel_range = g
+        # Multiplier from raw value to meters per second squared
+        self._accel_scale = (g * self.GRAVITIY_MS2) / 32768
+
+    def _set_gyro_range(self, t):
+        self._gyro_range = t
+        # Multiplier from raw value to degrees per second
+        self._gyro_scale = t / 32768
 
     def _read_i2c_word(self, register: int) -> int:
         # Read data from a pair of consecutive registers
-        with SMBus(self._bus) as bus:
+        start = self.profiler.clock() if self.profiler.enabled else None
+        with self._bus.transaction() as bus:
             high = bus.read_byte_data(self._address, register)
             low = bus.read_byte_data(self._address, register + 1)
+        if start is not None:
+            self.profiler.record('mpu9150', register, start, nbytes=2)
 
         value = (high << 8) + low
         if value >= 0x8000:
@@ -60,8 +312,12 @@ class MPU9150:
         """
         Read a single byte from a register
         """
-        with SMBus(self._bus) as bus:
-            return bus.read_byte_data(self._address, register)
+        start = self.profiler.clock() if self.profiler.enabled else None
+        with self._bus.transaction() as bus:
+            value = bus.read_byte_data(self._address, register)
+        if start is not None:
+            self.profiler.record('mpu9150', register, start, nbytes=1)
+        return value
 
     @property
     def temperature(self):
@@ -77,11 +333,7 @@ class MPU9150:
         """
         Acceleration range in g, will be one of 2, 4, 8, 16
         """
-        raw_data = self._read_i2c_byte(self.ACCEL_CONFIG)
-        for g, raw in self.ACCEL_RANGES.items():
-            if raw == raw_data:
-                return g
-        return None
+        return self._accel_range
 
     @accel_range.setter
     def accel_range(self, g):
@@ -90,9 +342,10 @@ class MPU9150:
         """
         if g in self.ACCEL_RANGES:
             raw_data = self.ACCEL_RANGES[g]
-            with SMBus(self._bus) as bus:
+            with self._bus.transaction() as bus:
                 bus.write_byte_data(self._address, self.ACCEL_CONFIG, 0x00)
                 bus.write_byte_data(self._address, self.ACCEL_CONFIG, raw_data)
+            self._set_accel_range(g)
         else:
             raise ValueError(f'acceleration range must be in {self.ACCEL_RANGES.keys()}')
 
@@ -104,11 +357,33 @@ class MPU9150:
         ACCEL_XOUT0 = 0x3B
         ACCEL_YOUT0 = 0x3D
         ACCEL_ZOUT0 = 0x3F
-        GRAVITIY_MS2 = 9.80665
-        scale = 32768 / (self.accel_range * GRAVITIY_MS2)
-        return {'x': self._read_i2c_word(ACCEL_XOUT0) / scale,
-                'y': self._read_i2c_word(ACCEL_YOUT0) / scale,
-                'z': self._read_i2c_word(ACCEL_ZOUT0) / scale}
+        scale = self._accel_scale
+        return {'x': self._read_i2c_word(ACCEL_XOUT0) * scale,
+                'y': self._read_i2c_word(ACCEL_YOUT0) * scale,
+                'z': self._read_i2c_word(ACCEL_ZOUT0) * scale}
+
+    def read_frame(self) -> IMUFrame:
+        """
+        Read acceleration, temperature and gyro in a single I2C block read, rather than the dozen or so single
+        byte transactions needed to read them through the individual properties.
+
+        :return:
+            An :class:`IMUFrame` containing scaled values
+        """
+        start = self.profiler.clock() if self.profiler.enabled else None
+        with self._bus.transaction() as bus:
+            raw = bus.read_i2c_block_data(self._address, self.SENSOR_OUT, self.SENSOR_FRAME.size)
+        if start is not None:
+            self.profiler.record('mpu9150', self.SENSOR_OUT, start, nbytes=self.SENSOR_FRAME.size)
+        ax, ay, az, temp, gx, gy, gz = self.SENSOR_FRAME.unpack(bytes(raw))
+        accel_scale = self._accel_scale
+        gyro_scale = self._gyro_scale
+        frame = IMUFrame(accel_x=ax * accel_scale, accel_y=ay * accel_scale, accel_z=az * accel_scale,
+                         temperature=(temp / 340.0) + 35,
+                         gyro_x=gx * gyro_scale, gyro_y=gy * gyro_scale, gyro_z=gz * gyro_scale)
+        if self.telemetry is not None:
+            self.telemetry.set_imu(frame)
+        return frame
 
     @property
     def magnetometer(self):
@@ -120,7 +395,7 @@ class MPU9150:
         MAG_ZOUT0 = 0x07
         MAG_CTRL = 0x0A
         scale = 1229 / 4096
-        with SMBus(bus=self._bus) as bus:
+        with self._bus.transaction() as bus:
             bus.write_byte_data(i2c_addr=self._address, register=MAG_CTRL, value=0b001)
         return {'x': self._read_twos_complement_word(MAG_XOUT0) * scale,
                 'y': self._read_twos_complement_word(MAG_YOUT0) * scale,
@@ -128,7 +403,7 @@ class MPU9150:
 
     def _read_twos_complement_word(self, register: int) -> int:
         # Read data from a pair of consecutive registers
-        with SMBus(self._bus) as bus:
+        with self._bus.transaction() as bus:
             high = bus.read_byte_data(self._address, register)
             low = bus.read_byte_data(self._address, register + 1)
         if high > 15:
@@ -141,19 +416,16 @@ class MPU9150:
         """
         Gyro range will be one of 250, 500, 1000, or 2000
         """
-        raw_data = self._read_i2c_byte(self.GYRO_CONFIG)
-        for t, raw in self.GYRO_RANGES.items():
-            if raw == raw_data:
-                return t
-        return None
+        return self._gyro_range
 
     @gyro_range.setter
     def gyro_range(self, t):
         if t in self.GYRO_RANGES:
             raw_data = self.GYRO_RANGES[t]
-            with SMBus(self._bus) as bus:
+            with self._bus.transaction() as bus:
                 bus.write_byte_data(self._address, self.GYRO_CONFIG, 0x00)
                 bus.write_byte_data(self._address, self.GYRO_CONFIG, raw_data)
+            self._set_gyro_range(t)
         else:
             raise ValueError(f'gyro range must be in {self.GYRO_RANGES.keys()}')
 
@@ -165,10 +437,10 @@ class MPU9150:
         GYRO_XOUT0 = 0x43
         GYRO_YOUT0 = 0x45
         GYRO_ZOUT0 = 0x47
-        scale = 32768 / self.gyro_range
-        return {'x': self._read_i2c_word(GYRO_XOUT0) / scale,
-                'y': self._read_i2c_word(GYRO_YOUT0) / scale,
-                'z': self._read_i2c_word(GYRO_ZOUT0) / scale}
+        scale = self._gyro_scale
+        return {'x': self._read_i2c_word(GYRO_XOUT0) * scale,
+                'y': self._read_i2c_word(GYRO_YOUT0) * scale,
+                'z': self._read_i2c_word(GYRO_ZOUT0) * scale}
 
 
 class Arduino:
@@ -177,9 +449,102 @@ class Arduino:
     encoders on the wheels, and the integrated neopixel strips and rings
     """
 
-    def __init__(self, address=0x70, bus=1):
-        self._bus = bus
+    # Version 2 protocol registers, a single byte register select followed by a read of the whole frame
+    PROTOCOL_VERSION_READ = 0x24
+    ENCODER_READ_BLOCK = 0x25
+    # Three big-endian unsigned 16 bit encoder counts, sequence number, XOR checksum
+    ENCODER_FRAME = struct.Struct('>3HBB')
+    # Version 3 protocol, motor powers written and encoder counts plus a microsecond timestamp read back
+    DRIVE_AND_SAMPLE = 0x26
+    TIMED_ENCODER_FRAME = struct.Struct('>3HIBB')
+
+    # Per-pixel lighting, the firmware takes a start pixel, a count, then HSV bytes for each pixel. Commands are
+    # limited to MAX_SENT_BYTES including the register, so allowing for register, start, count and checksum we can
+    # send at most PIXELS_PER_GROUP pixels in one command.
+    UPDATE_LED_GROUP = 0x23
+    MAX_SENT_BYTES = 26
+    PIXELS_PER_GROUP = (MAX_SENT_BYTES - 4) // 3
+    NUM_LEDS = 48
+    # The firmware sets the pylon pixels to show wheel speeds whenever it receives motor powers, so after each motor
+    # write we no longer know what they show
+    WHEEL_SPEED_PIXELS = 24
+    _UNKNOWN_WHEEL_SPEED_PIXELS = (None,) * WHEEL_SPEED_PIXELS
+
+    def __init__(self, address=0x70, bus: Union[int, I2CBus] = 1, protocol: int = None, max_pixel_rate: float = 20,
+                 retry_policy: RetryPolicy = None, counts_per_revolution: int = 3310,
+                 max_rotations_per_second: float = 1.0, refresh_interval: float = 0.5):
+        """
+        Constructor
+
+        :param int address:
+            I2C address of the Arduino
+        :param bus:
+            Either an I2C bus number or an :class:`I2CBus`
+        :param int protocol:
+            Protocol version the firmware supports. If None this is read from the Arduino. Older firmware which
+            doesn't know about protocol versions will stop the motors and set the lights to red when asked, so if
+            you know you're talking to such firmware pass protocol=1 to avoid this.
+        :param float max_pixel_rate:
+            Maximum number of pixel frames per second sent by set_pixels, to stop LED animation taking bus time
+            needed for motor control
+        :param RetryPolicy retry_policy:
+            Retry policy for failed writes, defaults to a :class:`RetryPolicy` with default settings
+        :param int counts_per_revolution:
+            Encoder counts per wheel revolution, used with max_rotations_per_second to detect encoder wraps
+        :param float max_rotations_per_second:
+            Fastest any wheel can turn. Encoder counts wrap every 65536 counts, and between reads further apart than
+            half a wrap at this speed the number of wraps is ambiguous, see cumulative_counts.
+        :param float refresh_interval:
+            Motor powers and solid colours identical to those last sent are skipped, and counted in stats.skipped,
+            unless this many seconds have passed since they were sent, in which case they're sent again as a
+            keep-alive. Set to 0 to send every write.
+        """
+        self._bus = I2CBus.shared(bus)
         self._address = address
+        self.retry_policy = retry_policy or RetryPolicy()
+        #: :class:`I2CStats` for writes to the Arduino
+        self.stats = I2CStats()
+        #: :class:`triangula.profiling.Profiler` to which transactions are reported
+        self.profiler = PROFILER
+        #: Optional :class:`triangula.telemetry.TelemetryRecorder` to which motor powers and encoders are reported
+        self.telemetry = None
+        self.protocol = protocol if protocol is not None else self._read_protocol_version()
+        self.encoder_sequence = None
+        # Signed cumulative encoder counts, updated on every encoder read, with the raw counts and host time of the
+        # last read, and the per-wheel count rates over the last interval used to resolve ambiguous wraps. Allow a
+        # margin over the nominal top speed when deciding whether a read could have wrapped.
+        self._max_count_rate = counts_per_revolution * max_rotations_per_second * 1.5
+        self._cumulative = array('q', [0, 0, 0])
+        self._count_rates = array('d', [0, 0, 0])
+        self._last_counts = None
+        self._last_count_time = None
+        #: Number of encoder reads where a wheel may have wrapped more than once since the previous read, and where
+        #: a wheel appeared to move faster than it can
+        self.ambiguous_encoder_reads = 0
+        self.implausible_encoder_reads = 0
+        # Arduino micros() wraps every 71 minutes or so, track the last value and accumulated wraps
+        self._last_micros = None
+        self._micros_offset = 0
+        # HSV byte triples for each pixel, as requested and as last sent to the firmware
+        self._pixels_requested = [None] * Arduino.NUM_LEDS
+        self._pixels_sent = [None] * Arduino.NUM_LEDS
+        self._pixel_interval = IntervalCheck(interval=1 / max_pixel_rate)
+        # Motor powers and checksum, to be sent and as last sent with the time they were sent
+        self._motor_block = bytearray(4)
+        self._motor_sent = bytearray(4)
+        self._motor_sent_time = None
+        self._colour_sent_time = None
+        self.refresh_interval = refresh_interval
+        # Register, motor powers and checksum for drive_and_sample, and the last sample it read
+        self._drive_block = bytearray([Arduino.DRIVE_AND_SAMPLE, 0, 0, 0, 0])
+        self._last_sample = None
+        # Buffers into which frames are read, and the messages for the combined drive and sample exchange, built once
+        # around the command block and frame buffer so filling in the block and reading the frame allocate nothing
+        self._encoder_frame = bytearray(Arduino.ENCODER_FRAME.size)
+        self._sample_frame = bytearray(Arduino.TIMED_ENCODER_FRAME.size)
+        self._drive_messages = (
+            Arduino._shared_message(i2c_msg.write(address, self._drive_block), self._drive_block),
+            Arduino._shared_message(i2c_msg.read(address, len(self._sample_frame)), self._sample_frame))
         add_properties(board=self, leds=[0])
         self.led0_brightness = 0.8
         self.led0_gamma = 1.5
@@ -190,66 +555,417 @@ class Arduino:
 
     @staticmethod
     def _check_byte(b: int) -> int:
-        return min(255, max(0, int(b)))
-
-    def _send(self, register: int, data: List[int]):
-        def checksum():
-            xor = register
-            for data_byte in data:
-                xor ^= data_byte
-            return [xor]
-
-        with SMBus(self._bus) as bus:
-            block = data + checksum()
-            LOG.debug(f'sending "{block}" to I2C')
-            try:
-                bus.write_i2c_block_data(i2c_addr=self._address,
-                                         register=register,
-                                         data=data + checksum())
-            except IOError:
-                retries = 0
-                success = False
-                while retries < 10 and not success:
-                    try:
-                        sleep(0.02)
-                        bus.write_i2c_block_data(i2c_addr=self._address,
-                                                 register=register,
-                                                 data=data + checksum())
-                        success = True
-                    except IOError:
-                        retries += 1
+        # Called several times a tick, and min() and max() allocate a tuple for their arguments on every call
+        b = int(b)
+        return 0 if b < 0 else 255 if b > 255 else b
+
+    @staticmethod
+    def _shared_message(message: i2c_msg, block: bytearray) -> i2c_msg:
+        # Point the message at the block's memory, so it can be reused with the block changed or read in place
+        message.buf = ctypes.cast((ctypes.c_char * len(block)).from_buffer(block), ctypes.POINTER(ctypes.c_char))
+        return message
+
+    @staticmethod
+    def _checksum(register: int, data: List[int]) -> int:
+        xor = register
+        for data_byte in data:
+            xor ^= data_byte
+        return xor
+
+    def _send(self, register: int, data: List[int]) -> bool:
+        """
+        Send a command with a trailing checksum, retrying according to the retry policy
+
+        :return:
+            True if the command was sent, False if we gave up and the policy doesn't raise on failure
+        :raises I2CWriteError:
+            If the command couldn't be sent and the policy raises on failure
+        """
+        return self._send_block(register, data + [Arduino._checksum(register, data)])
 
+    def _send_block(self, register: int, block) -> bool:
+        """
+        Send a block of data which already ends with its checksum, as _send. The block can be any sequence of byte
+        values, including a reused bytearray.
+        """
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug('sending "%s" to I2C', list(block))
+        policy = self.retry_policy
+        stats = self.stats
+        profiler = self.profiler
+        profile_start = profiler.clock() if profiler.enabled else None
+        start = monotonic()
+        delay = policy.backoff
+        attempt = 1
+        while True:
+            try:
+                with self._bus.transaction() as bus:
+                    bus.write_i2c_block_data(i2c_addr=self._address,
+                                             register=register,
+                                             data=block)
+                stats.writes += 1
+                if profile_start is not None:
+                    profiler.record('arduino', register, profile_start, nbytes=len(block) + 1, retries=attempt - 1)
+                return True
+            except IOError as e:
+                stats.nacks += 1
+                if attempt >= policy.max_attempts or monotonic() + delay - start > policy.deadline:
+                    stats.give_ups += 1
+                    if profile_start is not None:
+                        profiler.record('arduino', register, profile_start, nbytes=0, retries=attempt - 1,
+                                        error=True)
+                    message = f'gave up writing to register {register:#04x} after {attempt} attempts'
+                    if policy.raise_on_failure:
+                        raise I2CWriteError(message) from e
+                    LOG.warning(message)
+                    return False
+            stats.retries += 1
+            attempt += 1
+            sleep(delay)
+            delay *= 2
 
     def _read(self, register: int, bytes_to_read: int):
-        self._send(register, [0])
-        with SMBus(self._bus) as bus:
-            # Arduino code expects to see one at a time requests here, so while
-            # the newer smbus2 actually works fine with a bulk read, the microcontroller
-            # code does not and I don't really want to mess around with it now.
-            return [bus.read_byte(self._address) for _ in range(bytes_to_read)]
-            # return bus.read_i2c_block_data(i2c_addr=self._address, register=register, length=bytes_to_read)
+        # Hold the bus lock across the register select and the reads so another task can't slip in between them
+        with self._bus.lock:
+            self._send(register, [0])
+            start = self.profiler.clock() if self.profiler.enabled else None
+            with self._bus.transaction() as bus:
+                # Arduino code expects to see one at a time requests here, so while
+                # the newer smbus2 actually works fine with a bulk read, the microcontroller
+                # code does not and I don't really want to mess around with it now.
+                data = [bus.read_byte(self._address) for _ in range(bytes_to_read)]
+                # data = bus.read_i2c_block_data(i2c_addr=self._address, register=register, length=bytes_to_read)
+            if start is not None:
+                self.profiler.record('arduino', register, start, nbytes=bytes_to_read)
+            return data
+
+    def _read_protocol_version(self) -> int:
+        """
+        Ask the firmware which protocol version it speaks. Version 1 firmware answers with a zero byte.
+        """
+        try:
+            with self._bus.transaction() as bus:
+                version = bus.read_i2c_block_data(self._address, self.PROTOCOL_VERSION_READ, 1)[0]
+        except IOError:
+            LOG.warning('unable to read Arduino protocol version, assuming version 1')
+            version = 1
+        return max(1, version)
+
+    def _read_frame(self, register: int, frame: struct.Struct, buffer: bytearray, messages=None) -> Optional[tuple]:
+        """
+        Read a version 2 frame, consisting of a register select followed by a single block read, verifying the
+        trailing XOR checksum. If a pair of messages is supplied, a command write followed by a read into the buffer,
+        they're sent in a combined transaction in place of the plain register select and read. Attempts which fail,
+        either with an IOError from the bus or with a bad checksum, are retried according to the retry policy and
+        counted in stats, as for _send. The caller must hold the bus lock, as the buffer is reused.
+
+        :param frame:
+            Layout of the frame, ending with the checksum byte
+        :param buffer:
+            Reused buffer of frame.size bytes into which the frame is read
+        :param messages:
+            Write and read messages for a combined transaction, the read message being built around the buffer
+        :return:
+            The unpacked frame, including the checksum as its last field, or None if we gave up and the policy doesn't
+            raise on failure
+        :raises I2CWriteError:
+            If no valid frame could be read and the policy raises on failure
+        """
+        policy = self.retry_policy
+        stats = self.stats
+        profiler = self.profiler
+        profile_start = profiler.clock() if profiler.enabled else None
+        start = monotonic()
+        delay = policy.backoff
+        attempt = 1
+        error = None
+        while True:
+            try:
+                with self._bus.transaction() as bus:
+                    if messages is None:
+                        buffer[:] = bus.read_i2c_block_data(self._address, register, frame.size)
+                    else:
+                        bus.i2c_rdwr(*messages)
+                # XOR over the data including the checksum is zero if the checksum matches
+                if Arduino._checksum(register, buffer) == 0:
+                    if messages is not None:
+                        stats.writes += 1
+                    if profile_start is not None:
+                        profiler.record('arduino', register, profile_start,
+                                        nbytes=frame.size + (messages[0].len if messages else 1), retries=attempt - 1)
+                    return frame.unpack_from(buffer)
+                LOG.debug('bad checksum in frame from register %s: %s', register, list(buffer))
+            except IOError as e:
+                stats.nacks += 1
+                error = e
+            if attempt >= policy.max_attempts or monotonic() + delay - start > policy.deadline:
+                stats.give_ups += 1
+                if profile_start is not None:
+                    profiler.record('arduino', register, profile_start, retries=attempt - 1, error=True)
+                message = f'no valid frame from register {register:#04x} after {attempt} attempts'
+                if policy.raise_on_failure:
+                    raise I2CWriteError(message) from error
+                LOG.warning(message)
+                return None
+            stats.retries += 1
+            attempt += 1
+            sleep(delay)
+            delay *= 2
 
     def _set_led_rgb(self, led: int = 0, red: float = 0, green: float = 0, blue: float = 0):
         assert led == 0
         light_values = list([Arduino._check_byte(f * 255) for f in colorsys.rgb_to_hsv(red, blue, green)])
-        self._send(register=0x21, data=light_values)
+        colour = tuple(light_values)
+        now = monotonic()
+        # Skip if every pixel already shows this colour, unless it's time for a refresh
+        if self._colour_sent_time is not None and now - self._colour_sent_time < self.refresh_interval and \
+                all(pixel == colour for pixel in self._pixels_sent):
+            self.stats.skipped += 1
+        elif self._send(register=0x21, data=light_values):
+            self._colour_sent_time = now
+            # Solid colour sets every pixel
+            self._pixels_sent = [colour] * Arduino.NUM_LEDS
+        else:
+            self._colour_sent_time = None
+        self._pixels_requested = [colour] * Arduino.NUM_LEDS
+
+    def set_pixels(self, start: int, hsv_array):
+        """
+        Set individual pixel colours. Pixels are only sent to the Arduino if they've changed since they were last
+        sent, and whole frames are sent at most max_pixel_rate times per second; if called more often than this the
+        requested colours are held until the next call which is allowed to send them, or until flush_pixels is
+        called. Note that the firmware sets the pylon pixels, 0 to 23, to indicate wheel speeds whenever the motor
+        powers are set, this will override anything set here until these pixels are next sent.
+
+        :param int start:
+            Index of the first pixel to set, from 0 to 47
+        :param hsv_array:
+            Sequence of (hue, saturation, value) colours, each component from 0 to 1.0, to set on consecutive
+            pixels starting at the start index
+        :return:
+            True if the frame was sent, False if it was held back by the rate limit
+        """
+        if start < 0 or start + len(hsv_array) > Arduino.NUM_LEDS:
+            raise ValueError(f'pixels must be in the range 0 to {Arduino.NUM_LEDS - 1}')
+        for index, hsv in enumerate(hsv_array, start):
+            self._pixels_requested[index] = tuple(Arduino._check_byte(f * 255) for f in hsv)
+        if self._pixel_interval.should_run():
+            self.flush_pixels()
+            return True
+        return False
+
+    def flush_pixels(self):
+        """
+        Send any pixels which have been changed by set_pixels since they were last sent, regardless of the rate
+        limit. Each run of changed pixels is sent as the fewest commands which fit in the firmware's command buffer.
+        """
+        requested = self._pixels_requested
+        sent = self._pixels_sent
+        pixel = 0
+        while pixel < Arduino.NUM_LEDS:
+            if requested[pixel] is None or requested[pixel] == sent[pixel]:
+                pixel += 1
+                continue
+            # Extend the run of changed pixels up to the maximum we can send in a single command
+            end = pixel + 1
+            while end < min(Arduino.NUM_LEDS, pixel + Arduino.PIXELS_PER_GROUP) and \
+                    requested[end] is not None and requested[end] != sent[end]:
+                end += 1
+            data = [pixel, end - pixel]
+            for hsv in requested[pixel:end]:
+                data.extend(hsv)
+            # Leave pixels marked as unsent if the write fails, so they're tried again on the next flush
+            if self._send(register=Arduino.UPDATE_LED_GROUP, data=data):
+                sent[pixel:end] = requested[pixel:end]
+            pixel = end
 
     def set_motor_power(self, a, b, c):
         """
         Set motor powers, values from -1.0 to 1.0
         """
-        self._send(register=0x20, data=[Arduino._float_to_byte(-f) for f in [a, b, c]])
+        # Sent on every tick of the motion loop, so fill in a reused block rather than building lists. Hold the bus
+        # lock so the block can't be changed by another thread while it's being sent, acquiring and releasing it
+        # explicitly as a 'with' clause on a lock allocates on every call.
+        lock = self._bus.lock
+        lock.acquire()
+        try:
+            block = self._motor_block
+            block[0] = Arduino._float_to_byte(-a)
+            block[1] = Arduino._float_to_byte(-b)
+            block[2] = Arduino._float_to_byte(-c)
+            block[3] = 0x20 ^ block[0] ^ block[1] ^ block[2]
+            # Powers are quantised to bytes, so small changes often leave them the same as those last sent
+            now = monotonic()
+            sent_time = self._motor_sent_time
+            if sent_time is not None and now - sent_time < self.refresh_interval and block == self._motor_sent:
+                self.stats.skipped += 1
+            elif self._send_block(0x20, block):
+                self._motor_sent[:] = block
+                self._motor_sent_time = now
+                self._pixels_sent[0:Arduino.WHEEL_SPEED_PIXELS] = Arduino._UNKNOWN_WHEEL_SPEED_PIXELS
+            else:
+                self._motor_sent_time = None
+        finally:
+            lock.release()
+        if self.telemetry is not None:
+            self.telemetry.set_power(a, b, c)
 
-    def stop(self):
+    def drive_and_sample(self, a, b, c) -> EncoderSample:
+        """
+        Set motor powers, values from -1.0 to 1.0, and read the encoder values in a single exchange. With firmware
+        older than protocol version 3 this falls back to separate calls to set_motor_power and encoder_values.
+
+        :return:
+            An :class:`EncoderSample` with the encoder values read as the motor powers were received. If the exchange
+            fails and the retry policy doesn't raise on failure, the previous sample is returned, or None if there
+            hasn't been one.
+        """
+        if self.protocol < 3:
+            self.set_motor_power(a, b, c)
+            counts = self.encoder_values
+            return EncoderSample(counts=counts, timestamp=self._last_count_time)
+        # As for set_motor_power, fill in a reused block and hold the bus lock while it's in use
+        lock = self._bus.lock
+        lock.acquire()
+        try:
+            block = self._drive_block
+            block[1] = Arduino._float_to_byte(-a)
+            block[2] = Arduino._float_to_byte(-b)
+            block[3] = Arduino._float_to_byte(-c)
+            block[4] = block[0] ^ block[1] ^ block[2] ^ block[3]
+            result = self._read_frame(register=self.DRIVE_AND_SAMPLE, frame=self.TIMED_ENCODER_FRAME,
+                                      buffer=self._sample_frame, messages=self._drive_messages)
+            if result is None:
+                # The powers may or may not have arrived, so don't skip sending them again
+                self._motor_sent_time = None
+            else:
+                # The firmware treats these as motor powers, so a following set_motor_power with the same values is
+                # redundant
+                sent = self._motor_sent
+                sent[0] = block[1]
+                sent[1] = block[2]
+                sent[2] = block[3]
+                sent[3] = 0x20 ^ block[1] ^ block[2] ^ block[3]
+                self._motor_sent_time = monotonic()
+                self._pixels_sent[0:Arduino.WHEEL_SPEED_PIXELS] = Arduino._UNKNOWN_WHEEL_SPEED_PIXELS
+        finally:
+            lock.release()
+        if result is None:
+            if self.telemetry is not None:
+                self.telemetry.set_power(a, b, c)
+            return self._last_sample
+        counts = [result[0], result[1], result[2]]
+        micros = result[3]
+        self.encoder_sequence = result[4]
+        if self._last_micros is not None and micros < self._last_micros:
+            self._micros_offset += 1 << 32
+        self._last_micros = micros
+        self._accumulate(counts)
+        sample = EncoderSample(counts=counts, timestamp=(micros + self._micros_offset) / 1e6)
+        self._last_sample = sample
+        if self.telemetry is not None:
+            self.telemetry.set_power(a, b, c)
+            self.telemetry.set_encoders(counts, sample.timestamp)
+        return sample
+
+    def _stop(self, **kwargs):
+        """
+        Stop the motors. Called by the stop() method which add_properties injects in place of any stop() defined
+        here, after it has turned off the LED.
+        """
         self.set_motor_power(0, 0, 0)
 
     @property
     def encoder_values(self):
         """
-        Raw values from the three rotary encoders attached to the motors
+        Raw values from the three rotary encoders attached to the motors. With protocol version 2 or later, if the
+        read fails and the retry policy doesn't raise on failure, the previous values are returned.
+
+        :raises IOError:
+            If the read fails and there are no previous values to return
         """
-        data = self._read(register=0x22, bytes_to_read=6)
-        return list([a * 256 + b for a, b in zip(data[::2], data[1::2])])
+        if self.protocol >= 2:
+            # Hold the bus lock, as for set_motor_power, while the reused frame buffer is in use
+            lock = self._bus.lock
+            lock.acquire()
+            try:
+                result = self._read_frame(register=self.ENCODER_READ_BLOCK, frame=self.ENCODER_FRAME,
+                                          buffer=self._encoder_frame)
+            finally:
+                lock.release()
+            if result is None:
+                if self._last_counts is None:
+                    raise IOError(f'no valid frame from register {self.ENCODER_READ_BLOCK:#04x}')
+                return list(self._last_counts)
+            # A new list each time, as callers such as DeadReckoning keep the counts they're given
+            counts = [result[0], result[1], result[2]]
+            sequence = result[3]
+            if self.encoder_sequence is not None and sequence != (self.encoder_sequence + 1) & 0xFF:
+                LOG.debug('encoder frame sequence jumped from %s to %s', self.encoder_sequence, sequence)
+            self.encoder_sequence = sequence
+        else:
+            data = self._read(register=0x22, bytes_to_read=6)
+            counts = list([a * 256 + b for a, b in zip(data[::2], data[1::2])])
+        self._accumulate(counts)
+        if self.telemetry is not None:
+            self.telemetry.set_encoders(counts)
+        return counts
+
+    @property
+    def cumulative_counts(self) -> List[int]:
+        """
+        Signed total counts for each encoder since the first encoder read or the last reset_cumulative_counts(),
+        updated whenever encoder values are read by encoder_values or drive_and_sample. Unlike the raw values these
+        don't wrap, so reads can be infrequent. Between reads close enough together that no wheel can travel half a
+        wrap (about ten seconds at full speed) each step is taken as the shortest way round, which is always correct.
+        For longer gaps the number of wraps is chosen to best match each wheel's speed over the previous interval,
+        and the read is counted in ambiguous_encoder_reads.
+        """
+        return list(self._cumulative)
+
+    @property
+    def cumulative_time(self):
+        """
+        Monotonic clock time of the encoder read which last updated cumulative_counts, or None if there hasn't been one
+        """
+        return self._last_count_time
+
+    def reset_cumulative_counts(self):
+        """
+        Reset cumulative_counts to zero as of the last encoder read
+        """
+        for i in range(3):
+            self._cumulative[i] = 0
+
+    def _accumulate(self, counts):
+        now = monotonic()
+        last = self._last_counts
+        if last is not None:
+            elapsed = now - self._last_count_time
+            limit = self._max_count_rate * elapsed
+            ambiguous = limit >= 32768
+            # Called on every encoder read, so step through the wheels with an index rather than allocating a range
+            i = 0
+            while i < 3:
+                # Shortest step, from -32768 to 32767
+                delta = ((counts[i] - last[i] + 32768) & 0xFFFF) - 32768
+                if ambiguous:
+                    # Choose the number of whole wraps which brings the step closest to that expected from the
+                    # wheel's previous speed
+                    expected = self._count_rates[i] * elapsed
+                    delta += round((expected - delta) / 65536) * 65536
+                elif abs(delta) > limit + 1:
+                    self.implausible_encoder_reads += 1
+                    LOG.debug('encoder %s moved %s counts in %.3fs, faster than possible', i, delta, elapsed)
+                self._cumulative[i] += delta
+                if elapsed > 0:
+                    self._count_rates[i] = delta / elapsed
+                i += 1
+            if ambiguous:
+                self.ambiguous_encoder_reads += 1
+                LOG.warning('%.1fs between encoder reads, wheels may have wrapped more than once', elapsed)
+        self._last_counts = counts
+        self._last_count_time = now
 
 
 class P017LCD:
@@ -259,12 +975,54 @@ class P017LCD:
 
     Backlight is available as the led0 property, can be set to CSS4 colours by name as per
     approxeng.hwsupport LED management. Set text by writing to the 'text' property.
+
+    The driver keeps a copy of what's currently shown on the display, and when the text is changed only sends the
+    characters which have actually changed, moving the cursor to each changed section in turn. At 9600 baud a full
+    redraw takes around 60ms, where updating a few digits takes a fraction of that.
+
+    The serial port is opened on first use and kept open until close() is called, or the display is used in a 'with'
+    clause. If a write fails the port is closed and re-opened for the next write.
     """
 
-    def __init__(self, port='/dev/serial0', baudrate=9600, min_delay=0.05, columns=16, rows=2):
+    # Display RAM address of the start of each row, and the controller instruction to move the cursor to an address
+    ROW_ADDRESSES = [0x00, 0x40, 0x14, 0x54]
+    SET_ADDRESS = 0x80
+    # Moving the cursor costs 'pc', up to three digits and a carriage return, then 'pd' and another carriage return
+    # to start writing characters again, so it's cheaper to rewrite unchanged runs shorter than this than to skip them
+    REPOSITION_COST = 9
+
+    def __init__(self, port='/dev/serial0', baudrate=9600, min_delay=0.05, columns=16, rows=2, write_timeout=0.1,
+                 serial_factory=serial.Serial):
+        """
+        Constructor
+
+        :param str port:
+            Serial port device
+        :param int baudrate:
+            Serial baud rate, the P017 defaults to 9600
+        :param float min_delay:
+            Minimum time in seconds between writes to the display
+        :param int columns:
+            Number of characters in each row
+        :param int rows:
+            Number of rows
+        :param float write_timeout:
+            Maximum time in seconds a write can block before failing. Writes normally return as soon as the data is
+            in the kernel's buffer, this only comes into play if the port isn't draining.
+        :param serial_factory:
+            Called with port, baudrate and write_timeout keyword arguments to open the serial port, defaults to
+            serial.Serial
+        """
         self._port = port
         self._baudrate = baudrate
+        self._write_timeout = write_timeout
+        self._serial = None
+        self._serial_factory = serial_factory
+        #: :class:`triangula.profiling.Profiler` to which writes are reported
+        self.profiler = PROFILER
         self._text = [''] * rows
+        # What we believe is on the display, None for rows we don't know about
+        self._shown = [None] * rows
         self._interval = IntervalCheck(interval=min_delay)
         self._columns = columns
         self._rows = rows
@@ -272,7 +1030,7 @@ class P017LCD:
 
     @property
     def text(self):
-        return self._rows
+        return self._text
 
     @text.setter
     def text(self, new_text):
@@ -280,8 +1038,15 @@ class P017LCD:
         Set text either with a string (which will be wrapped around the columns) or with a list of
         strings which will be treated as rows. In our case we only have two rows!
         """
+        if new_text == self._text and None not in self._shown:
+            # Set on every display update of the motion loop, often with the same text, so return before building
+            # anything if it's already shown
+            return
         if isinstance(new_text, str):
-            self._text = list(new_text[row * self._columns:self._columns] for row in range(self._rows))
+            # A loop rather than a generator, which would capture self and new_text in cells allocated on every call
+            self._text = [''] * self._rows
+            for row in range(self._rows):
+                self._text[row] = new_text[row * self._columns:(row + 1) * self._columns]
             self._update()
         elif isinstance(new_text, list):
             self._text = [''] * self._rows
@@ -297,6 +1062,8 @@ class P017LCD:
         """
         with self._interval:
             self._send('pc1')
+        self._text = [''] * self._rows
+        self._shown = [' ' * self._columns] * self._rows
 
     def cursor_off(self):
         """
@@ -332,11 +1099,85 @@ class P017LCD:
             self._send('pb' + to_range(red) + ',' + to_range(green) + ',' + to_range(blue))
 
     def _update(self):
-        with self._interval:
-            self._send('pc2')
-            self._send('pd' + self._text[0].ljust(40) + self._text[1].ljust(16))
+        commands = []
+        shown = list(self._shown)
+        for row in range(self._rows):
+            wanted = self._text[row].ljust(self._columns)
+            for start, end in P017LCD._changed_ranges(shown[row], wanted):
+                commands.append(f'pc{P017LCD.SET_ADDRESS + P017LCD.ROW_ADDRESSES[row] + start}')
+                commands.append('pd' + wanted[start:end])
+            shown[row] = wanted
+        if commands:
+            try:
+                with self._interval:
+                    self._send(*commands)
+            except IOError:
+                # Don't know how much was written, so redraw everything next time
+                self._shown = [None] * self._rows
+                raise
+        self._shown = shown
+
+    @staticmethod
+    def _changed_ranges(shown, wanted):
+        """
+        Find the ranges of columns which differ between two versions of a row, as a list of [start, end) pairs.
+        Ranges separated by fewer than REPOSITION_COST unchanged characters are merged. If the shown row is None we
+        don't know what's on the display, so the whole row is treated as having changed.
+        """
+        if shown is None:
+            return [[0, len(wanted)]]
+        ranges = []
+        for column, (old, new) in enumerate(zip(shown, wanted)):
+            if old != new:
+                if ranges and column - ranges[-1][1] < P017LCD.REPOSITION_COST:
+                    ranges[-1][1] = column + 1
+                else:
+                    ranges.append([column, column + 1])
+        return ranges
+
+    def open(self):
+        """
+        Open the serial port if it isn't already open
+        """
+        if self._serial is None:
+            self._serial = self._serial_factory(port=self._port, baudrate=self._baudrate,
+                                                write_timeout=self._write_timeout)
+        return self._serial
 
-    def _send(self, command):
-        with serial.Serial(port=self._port, baudrate=self._baudrate) as ser:
-            ser.write(command.encode('UTF-8') + bytes([0xd]))
-            LOG.debug(f'written "{command}" to serial')
+    def close(self):
+        """
+        Close the serial port, it will be re-opened if the display is used again
+        """
+        if self._serial is not None:
+            try:
+                self._serial.close()
+            finally:
+                self._serial = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _send(self, *commands):
+        """
+        Send one or more commands in a single write, each terminated with a carriage return. If the write fails the
+        port is closed and re-opened, and the write tried once more before giving up.
+        """
+        data = b''.join(command.encode('UTF-8') + b'\r' for command in commands)
+        start = self.profiler.clock() if self.profiler.enabled else None
+        for attempt in range(2):
+            try:
+                self.open().write(data)
+                LOG.debug('written "%s" to serial', commands)
+                if start is not None:
+                    self.profiler.record('p017lcd', None, start, nbytes=len(data), retries=attempt)
+                return
+            except serial.SerialException:
+                self.close()
+                if attempt:
+                    if start is not None:
+                        self.profiler.record('p017lcd', None, start, retries=attempt, error=True)
+                    raise
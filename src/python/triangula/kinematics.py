@@ -0,0 +1,99 @@
+"""
+Fast path for the chassis kinematics in the motion loop. HoloChassis.get_wheel_speeds is general, and builds several
+objects on every call, but for a fixed chassis the mapping from robot velocity to wheel speeds is just a 3x3 matrix.
+:class:`ChassisKinematics` works this out once, folds in each wheel's maximum speed, and then maps velocity straight to
+motor powers with a handful of multiplications.
+
+The matrix is found by probing the chassis rather than from its geometry directly, so the fast path matches whatever
+the chassis itself would calculate.
+"""
+from typing import List
+
+
+def wheel_matrix(chassis, probe: float = 1e-3) -> list:
+    """
+    The chassis inverse kinematics as a 3x3 matrix, mapping robot frame velocity (x, y, rotation) to wheel speeds in
+    revolutions per second, found by asking the chassis for the wheel speeds needed for small unit motions. Works for
+    any chassis the motion task can drive, as everything is derived from get_wheel_speeds.
+
+    :param chassis:
+        An approxeng.chassis HoloChassis with three wheels
+    :param float probe:
+        Magnitude of the probe motions, small enough that the chassis doesn't need to scale them down
+    :return:
+        The matrix as a list of three rows, one per wheel
+    """
+    from approxeng.chassis import Motion
+    from euclid import Vector2
+
+    columns = []
+    for motion in [Motion(translation=Vector2(probe, 0), rotation=0),
+                   Motion(translation=Vector2(0, probe), rotation=0),
+                   Motion(translation=Vector2(0, 0), rotation=probe)]:
+        wheel_speeds = chassis.get_wheel_speeds(motion=motion)
+        columns.append([speed / (wheel_speeds.scaling * probe) for speed in wheel_speeds.speeds])
+    return [[columns[column][row] for column in range(3)] for row in range(3)]
+
+
+class ChassisKinematics:
+    """
+    Precomputed inverse kinematics for a three wheeled chassis, mapping robot frame velocity to motor powers from -1.0
+    to 1.0, scaled down as get_wheel_speeds would if any wheel would otherwise need to exceed its maximum speed
+    """
+
+    __slots__ = ['m00', 'm01', 'm02', 'm10', 'm11', 'm12', 'm20', 'm21', 'm22', 'max_speeds']
+
+    def __init__(self, chassis=None, matrix=None, max_speeds=None):
+        """
+        Constructor
+
+        :param chassis:
+            An approxeng.chassis HoloChassis with three wheels, used to derive the matrix and maximum speeds if these
+            aren't specified
+        :param matrix:
+            Wheel matrix as returned by :func:`wheel_matrix`
+        :param max_speeds:
+            Maximum speed of each wheel in revolutions per second
+        """
+        if matrix is None:
+            matrix = wheel_matrix(chassis)
+        if max_speeds is None:
+            max_speeds = [wheel.maximum_rotation_per_second for wheel in chassis.wheels]
+        self.max_speeds = tuple(max_speeds)
+        # Rows divided through by maximum speed give power directly
+        (self.m00, self.m01, self.m02), (self.m10, self.m11, self.m12), (self.m20, self.m21, self.m22) = \
+            [[value / max_speed for value in row] for row, max_speed in zip(matrix, max_speeds)]
+
+    def powers(self, vx: float, vy: float, rotation: float, out: List[float]) -> List[float]:
+        """
+        Calculate motor powers for a motion
+
+        :param float vx:
+            Velocity along the robot's x axis, in the chassis units per second
+        :param float vy:
+            Velocity along the robot's y axis
+        :param float rotation:
+            Rotation in radians per second
+        :param out:
+            List of three floats to write the powers to, returned for convenience
+        :return:
+            The out list, containing the power for each wheel
+        """
+        a = self.m00 * vx + self.m01 * vy + self.m02 * rotation
+        b = self.m10 * vx + self.m11 * vy + self.m12 * rotation
+        c = self.m20 * vx + self.m21 * vy + self.m22 * rotation
+        # Scale all wheels together to keep the direction of motion if any is asked for more than full power. Found
+        # without max(), which allocates a tuple for its arguments on every call.
+        largest = abs(a)
+        if abs(b) > largest:
+            largest = abs(b)
+        if abs(c) > largest:
+            largest = abs(c)
+        if largest > 1.0:
+            a /= largest
+            b /= largest
+            c /= largest
+        out[0] = a
+        out[1] = b
+        out[2] = c
+        return out
@@ -1,4 +1,5 @@
-from math import degrees
+from math import degrees, cos, sin, pi
+from time import monotonic, sleep
 
 from approxeng.chassis import HoloChassis, DeadReckoning, rotate_vector, Motion
 from approxeng.chassis.dynamics import MotionLimit, RateLimit
@@ -6,23 +7,119 @@ from approxeng.input import Controller
 from approxeng.task import Task
 from euclid import Vector2
 
-from triangula.hardware import Arduino, P017LCD
-from triangula.util import IntervalCheck
+from triangula.conditioning import InputConditioner
+from triangula.control import WheelVelocityEstimator, PISpeedController
+from triangula.fusion import FusedPoseEstimator
+from triangula.hardware import Arduino, P017LCD, MPU9150
+from triangula.kinematics import ChassisKinematics
+from triangula.util import Scheduler, LoopTiming
 
 
 class ManualMotionTask(Task):
 
+    # Motion mode shown on the display, indexed by whether the bearing is absolute and then by limit mode
+    _MODE_STRINGS = (('REL', 'REL*', 'REL+'), ('ABS', 'ABS*', 'ABS+'))
+
     # noinspection PyTypeChecker
-    def __init__(self, accel_time=1.0):
-        super().__init__(name='manual_motion', resources=['arduino', 'display', 'joystick', 'chassis'])
+    def __init__(self, accel_time=1.0, pose_update_rate=10, pose_display_rate=5, loop_rate=None, clock=monotonic,
+                 sleep_function=sleep, telemetry=None, speed_control=False, speed_kp=0.5, speed_ki=2.0,
+                 velocity_time_constant=0.05, use_gyro=False, gyro_rate=200, gyro_sign=-1.0, deadband=0.02, expo=0.0,
+                 input_time_constant=0.05, change_threshold=0.01):
+        """
+        Constructor
+
+        :param float accel_time:
+            Time in seconds to accelerate to full speed when motion limits are enabled
+        :param float pose_update_rate:
+            Dead reckoning updates per second
+        :param float pose_display_rate:
+            Pose display updates per second
+        :param float loop_rate:
+            If specified, run the control loop at this many ticks per second, sleeping within each tick until the
+            next is due. If None each tick runs as soon as the task loop calls it.
+        :param clock:
+            Function returning the current time in seconds, defaults to time.monotonic
+        :param sleep_function:
+            Function used to sleep when running at a fixed rate, defaults to time.sleep
+        :param telemetry:
+            If specified, a :class:`triangula.telemetry.TelemetryRecorder` to which joystick inputs and pose are
+            written, committing a record on each tick
+        :param bool speed_control:
+            If True, use closed loop speed control. Encoders are sampled along with every motor power update, and a
+            :class:`triangula.control.PISpeedController` adjusts the powers to bring the measured wheel speeds to
+            those requested. If False motor powers are set open loop, in proportion to the requested speeds.
+        :param float speed_kp:
+            Proportional gain for closed loop speed control
+        :param float speed_ki:
+            Integral gain for closed loop speed control
+        :param float velocity_time_constant:
+            Time constant in seconds of the filter applied to measured wheel speeds
+        :param bool use_gyro:
+            If True, read the gyro from the 'mpu' resource and fuse it with odometry for a more accurate heading, see
+            :class:`triangula.fusion.FusedPoseEstimator`. If False the pose comes from odometry alone.
+        :param float gyro_rate:
+            Gyro reads per second when use_gyro is set
+        :param float gyro_sign:
+            Multiplier taking gyro z readings to the clockwise-positive pose convention, -1.0 for an IMU mounted with
+            its z axis pointing up and 1.0 for one with its z axis pointing down
+        :param float deadband:
+            Stick deflection below which an axis reads as zero
+        :param float expo:
+            Stick response curve, from 0.0 for linear to 1.0 for cubic
+        :param float input_time_constant:
+            Time constant in seconds of the filter applied to the sticks, 0 for none
+        :param float change_threshold:
+            Smallest change in a filtered stick value which is passed on, see
+            :class:`triangula.conditioning.InputConditioner`
+        """
+        resources = ['arduino', 'display', 'joystick', 'chassis']
+        if use_gyro:
+            resources.append('mpu')
+        super().__init__(name='manual_motion', resources=resources)
         self.accel_time = accel_time
         self.bearing_zero = None
         self.max_trn = 0
         self.max_rot = 0
         self.dead_reckoning = None
         ':type : '
-        self.pose_display_interval = IntervalCheck(interval=0.2)
-        self.pose_update_interval = IntervalCheck(interval=0.1)
+        # Periodic jobs within the motion loop, dead reckoning updates and pose display
+        self.scheduler = Scheduler(clock=clock)
+        self.scheduler.add('pose_update', rate=pose_update_rate)
+        self.scheduler.add('pose_display', rate=pose_display_rate)
+        self.loop_rate = loop_rate
+        self.control_job = self.scheduler.add('control', rate=loop_rate) if loop_rate else None
+        self._control_overruns = 0
+        self.use_gyro = use_gyro
+        self.gyro_sign = gyro_sign
+        if use_gyro:
+            self.scheduler.add('gyro_update', rate=gyro_rate)
+        self.sleep = sleep_function
+        #: :class:`triangula.util.LoopTiming` for the control loop, times in seconds
+        self.timing = LoopTiming()
+        self.show_timing = False
+        self._last_tick_start = None
+        self.telemetry = telemetry
+        #: :class:`triangula.control.WheelVelocityEstimator` with measured wheel speeds, updated on every encoder
+        #: read, so once per tick with speed control or at the pose update rate without
+        self.wheel_velocity = WheelVelocityEstimator(counts_per_revolution=3310, time_constant=velocity_time_constant)
+        self.speed_control = speed_control
+        self.speed_kp = speed_kp
+        self.speed_ki = speed_ki
+        self.speed_controller = None
+        ':type : triangula.control.PISpeedController'
+        self.kinematics = None
+        ':type : triangula.kinematics.ChassisKinematics'
+        self._rotation_sense = 1.0
+        # Reused for motor powers and speed targets on every tick
+        self._power = [0.0, 0.0, 0.0]
+        self._targets = [0.0, 0.0, 0.0]
+        self._sampled_counts = None
+        self.input_conditioner = InputConditioner(axes=3, deadband=deadband, expo=expo,
+                                                  time_constant=input_time_constant, change_threshold=change_threshold)
+        self._raw_axes = [0.0, 0.0, 0.0]
+        # Rounded x, y and bearing, and mode string, last shown on the display, the mode string None if the display
+        # has shown something else since
+        self._pose_shown = [None, None, None, None]
         self.rate_limit = None
         ':type : approxeng.chassis.dynamics.RateLimit'
         self.motion_limit = None
@@ -34,14 +131,26 @@ class ManualMotionTask(Task):
         world = Task.World(resources=self.ordered_resources,
                            task_count=self.task_count,
                            global_count=Task.global_count)
+        self.initialise(chassis=world.chassis, display=world.display)
+
+    def initialise(self, chassis: HoloChassis, display: P017LCD):
+        """
+        Set up the task state for a given chassis, called from startup(). This can also be called directly to drive
+        the task through manual_motion() without the task framework, as in benchmarks and replays.
+        """
         # Cache maximum translation and rotation speeds from chassis calculations
-        self.max_trn = world.chassis.get_max_translation_speed()
-        self.max_rot = world.chassis.get_max_rotation_speed()
+        self.max_trn = chassis.get_max_translation_speed()
+        self.max_rot = chassis.get_max_rotation_speed()
+        # Precompute the chassis kinematics, and find which way rotate_vector turns so absolute mode can do the same
+        self.kinematics = ChassisKinematics(chassis=chassis)
+        self._rotation_sense = 1.0 if rotate_vector(Vector2(1, 0), pi / 2).y > 0 else -1.0
         # Set relative motion
-        world.display.led0 = 'red'
+        display.led0 = 'red'
         self.bearing_zero = None
         # Initialise dead reckoning
-        self.dead_reckoning = DeadReckoning(chassis=world.chassis, counts_per_revolution=3310)
+        self.dead_reckoning = DeadReckoning(chassis=chassis, counts_per_revolution=3310)
+        if self.use_gyro:
+            self.dead_reckoning = FusedPoseEstimator(dead_reckoning=self.dead_reckoning, gyro_sign=self.gyro_sign)
         # Set up motion limits, simulate slower response to avoid damaging
         # tyres and other mechanical bits with overly vigorous acceleration
         self.motion_limit = MotionLimit(
@@ -49,15 +158,58 @@ class ManualMotionTask(Task):
             angular_acceleration_limit=self.max_rot / self.accel_time)
         self.rate_limit = RateLimit(limit_function=RateLimit.fixed_rate_limit_function(1 / self.accel_time))
         self.limit_mode = 0
+        self._pose_shown[3] = None
+        # Jobs were scheduled from when the task was constructed, start them from now instead
+        self.scheduler.reset()
+        self.timing.reset()
+        self._control_overruns = 0
+        self._last_tick_start = None
+        self.wheel_velocity.reset()
+        self._sampled_counts = None
+        self.input_conditioner.reset()
+        if self.speed_control:
+            self.speed_controller = PISpeedController(
+                max_speeds=[wheel.maximum_rotation_per_second for wheel in chassis.wheels],
+                kp=self.speed_kp, ki=self.speed_ki)
 
     def shutdown(self):
         pass
 
     def tick(self, world):
-        self.manual_motion(arduino=world.arduino, display=world.display,
-                           joystick=world.joystick, chassis=world.chassis)
+        clock = self.scheduler.clock
+        if self.control_job is not None:
+            # Running at a fixed rate, wait for the next control deadline
+            delay = self.control_job.deadline - clock()
+            if delay > 0:
+                self.sleep(delay)
+        start = clock()
+        if self._last_tick_start is not None:
+            self.timing.period.add(start - self._last_tick_start)
+        self._last_tick_start = start
+        io_time = self.manual_motion(arduino=world.arduino, display=world.display,
+                                     joystick=world.joystick, chassis=world.chassis,
+                                     mpu=world.mpu if self.use_gyro else None)
+        self.timing.io.add(io_time)
+        self.timing.compute.add(clock() - start - io_time)
+        if self.control_job is not None:
+            # Count overruns since the last tick, so the total stays in step with timing.reset()
+            overruns = self.control_job.overruns
+            self.timing.missed_deadlines += overruns - self._control_overruns
+            self._control_overruns = overruns
 
-    def manual_motion(self, arduino: Arduino, display: P017LCD, joystick: Controller, chassis: HoloChassis):
+    def manual_motion(self, arduino: Arduino, display: P017LCD, joystick: Controller, chassis: HoloChassis,
+                      mpu: MPU9150 = None) -> float:
+        """
+        Run a single step of the motion loop
+
+        :return:
+            Time in seconds spent on hardware I/O within this step
+        """
+        clock = self.scheduler.clock
+        io_time = 0.0
+        telemetry = self.telemetry
+        if telemetry is not None:
+            telemetry.set_joystick(joystick.lx, joystick.ly, joystick.rx, joystick.presses)
 
         # Check for mode changes
         if 'triangle' in joystick.presses:
@@ -74,61 +226,126 @@ class ManualMotionTask(Task):
         elif 'cross' in joystick.presses:
             # Cycle through limit modes
             self.limit_mode = (self.limit_mode + 1) % 3
+        elif 'select' in joystick.presses:
+            # Toggle between pose and loop timing display
+            self.show_timing = not self.show_timing
+
+        due = self.scheduler.due()
 
-        # Check to see whether the minimum interval between dead reckoning updates has passed
-        if self.pose_update_interval.should_run():
-            self.dead_reckoning.update_from_counts(arduino.encoder_values)
+        # Integrate the gyro at a high rate, between the less frequent odometry updates
+        if 'gyro_update' in due and mpu is not None:
+            io_start = clock()
+            frame = mpu.read_frame()
+            io_time += clock() - io_start
+            self.dead_reckoning.update_gyro(frame.gyro_z, io_start)
+
+        # Check to see whether the dead reckoning update is due
+        if 'pose_update' in due:
+            if self._sampled_counts is not None:
+                # Speed control samples the encoders every tick, no need to read them again
+                counts = self._sampled_counts
+            else:
+                io_start = clock()
+                counts = arduino.encoder_values
+                io_time += clock() - io_start
+                self.wheel_velocity.update(counts, clock())
+            self.dead_reckoning.update_from_counts(counts)
+            if telemetry is not None:
+                telemetry.set_pose(self.dead_reckoning.pose)
 
         # Update the display if appropriate
-        if self.pose_display_interval.should_run():
+        if 'pose_display' in due and self.show_timing:
+            # Median and 99th percentile loop period, worst case period, and number of missed deadlines
+            period = self.timing.period.summary()
+            io_start = clock()
+            display.text = ['p50{:4.1f} p99{:4.1f}'.format(period['p50'] * 1000, period['p99'] * 1000),
+                            'max{:5.1f} mis{:3d}'.format(period['max'] * 1000, self.timing.missed_deadlines % 1000)]
+            io_time += clock() - io_start
+            self._pose_shown[3] = None
+        elif 'pose_display' in due:
             pose = self.dead_reckoning.pose
-            mode_string = 'ABS'
-            if self.bearing_zero is None:
-                mode_string = 'REL'
-            if self.limit_mode == 1:
-                mode_string += '*'
-            elif self.limit_mode == 2:
-                mode_string += '+'
-            display.text = ['x:{:7.0f}, b:{:3.0f}'.format(pose.position.x, degrees(pose.orientation)),
-                            'y:{:7.0f}, {}'.format(pose.position.y, mode_string)]
-
-        # Get a vector from the left hand analogue stick and scale it up to our
+            x, y = round(pose.position.x), round(pose.position.y)
+            bearing = round(degrees(pose.orientation))
+            mode_string = ManualMotionTask._MODE_STRINGS[self.bearing_zero is not None][self.limit_mode]
+            # Only format new text if it would differ from what's shown, which it won't while the robot is still
+            shown = self._pose_shown
+            if x != shown[0] or y != shown[1] or bearing != shown[2] or mode_string is not shown[3]:
+                io_start = clock()
+                display.text = ['x:{:7d}, b:{:3d}'.format(x, bearing), 'y:{:7d}, {}'.format(y, mode_string)]
+                io_time += clock() - io_start
+                shown[0] = x
+                shown[1] = y
+                shown[2] = bearing
+                shown[3] = mode_string
+
+        # Condition the stick inputs, so noise from sticks held still doesn't change the
+        # motor powers on every tick
+        axes = self._raw_axes
+        axes[0] = joystick.lx
+        axes[1] = joystick.ly
+        axes[2] = joystick.rx
+        self.input_conditioner.update(axes, clock())
+        lx, ly, rx = self.input_conditioner.values
+
+        # Get the translation from the left hand analogue stick and scale it up to our
         # maximum translation speed, this will mean we go as fast directly forward
         # as possible when the stick is pushed fully forwards
+        vx = lx * self.max_trn
+        vy = ly * self.max_trn
 
-        translate = Vector2(
-            joystick.lx,
-            joystick.ly) * self.max_trn
-        ':type : euclid.Vector2'
-
-        # If we're in absolute mode, rotate the translation vector appropriately
+        # If we're in absolute mode, rotate the translation vector appropriately, in the
+        # same sense as rotate_vector
         if self.bearing_zero is not None:
-            translate = rotate_vector(translate,
-                                      self.bearing_zero - self.dead_reckoning.pose.orientation)
+            angle = (self.bearing_zero - self.dead_reckoning.pose.orientation) * self._rotation_sense
+            c, s = cos(angle), sin(angle)
+            vx, vy = c * vx - s * vy, s * vx + c * vy
 
         # Get the rotation in radians per second from the right hand stick's X axis,
         # scaling it to our maximum rotational speed. When standing still this means
         # that full right on the right hand stick corresponds to maximum speed
         # clockwise rotation.
-        rotate = joystick.rx * self.max_rot
-
-        # Given the translation vector and rotation, use the chassis object to calculate
-        # the speeds required in revolutions per second for each wheel. We'll scale these by the
-        # wheel maximum speeds to get a range of -1.0 to 1.0
-        # This is a :class:`triangula.chassis.WheelSpeeds` containing the speeds and any
-        # scaling applied to bring the requested velocity within the range the chassis can
-        # actually perform.
-        motion = Motion(translation=translate, rotation=rotate)
+        rotate = rx * self.max_rot
+
+        # Given the translation and rotation, work out the speeds required for each wheel,
+        # scaled by the wheel maximum speeds to get a range of -1.0 to 1.0, and scaled down
+        # together if the chassis can't actually perform the requested motion.
         if self.limit_mode == 2:
-            motion = self.motion_limit.limit_and_return(motion)
-        wheel_speeds = chassis.get_wheel_speeds(motion=motion)
-        speeds = wheel_speeds.speeds
+            # Motion limits work in terms of Motion objects, so go through the chassis
+            motion = self.motion_limit.limit_and_return(Motion(translation=Vector2(vx, vy), rotation=rotate))
+            speeds = chassis.get_wheel_speeds(motion=motion).speeds
+            # A loop rather than a comprehension, which would make speeds and chassis cells allocated on every call
+            power = self._power
+            for i in range(0, 3):
+                power[i] = speeds[i] / chassis.wheels[i].maximum_rotation_per_second
+        else:
+            # Precomputed kinematics give the same powers without building any objects
+            power = self.kinematics.powers(vx, vy, rotate, self._power)
 
         # Send desired motor speed values over the I2C bus to the Arduino, which will
         # then send the appropriate messages to the Syren10 controllers over its serial
         # line as well as lighting up a neopixel ring to provide additional feedback
         # and bling.
-        power = [speeds[i] / chassis.wheels[i].maximum_rotation_per_second for i in range(0, 3)]
         if self.limit_mode == 1:
-            power = self.rate_limit.limit_and_return(power)
-        arduino.set_motor_power(power[0], power[1], power[2])
+            power = self.rate_limit.limit_and_return(list(power))
+        if self.speed_controller is not None:
+            # Track the requested wheel speeds, sending the powers and sampling encoders in a single exchange
+            targets = self._targets
+            for i in range(0, 3):
+                targets[i] = power[i] * self.kinematics.max_speeds[i]
+            measured = self.wheel_velocity.speeds if self.wheel_velocity.valid else None
+            power = self.speed_controller.update(targets, measured, clock())
+            io_start = clock()
+            sample = arduino.drive_and_sample(power[0], power[1], power[2])
+            io_time += clock() - io_start
+            # None if the exchange failed before any encoders were read, try again next tick
+            if sample is not None:
+                self.wheel_velocity.update(sample.counts, sample.timestamp)
+                self._sampled_counts = sample.counts
+        else:
+            # The driver skips powers which haven't changed since they were last sent
+            io_start = clock()
+            arduino.set_motor_power(power[0], power[1], power[2])
+            io_time += clock() - io_start
+        if telemetry is not None:
+            telemetry.commit()
+        return io_time
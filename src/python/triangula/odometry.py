@@ -0,0 +1,109 @@
+"""
+Vectorised odometry for offline analysis. The motion task updates dead reckoning one encoder sample at a time, which is
+fine on the robot but slow when reconstructing the path from a long telemetry log. :func:`reconstruct_poses` does the
+same job for a whole array of encoder samples in a handful of NumPy operations::
+
+    log = TelemetryLog('/home/pi/run.tlm')
+    times, poses = reconstruct_log(log, chassis=chassis)
+
+Poses are x, y and orientation, with orientation in radians increasing in the same sense as the rotation part of an
+approxeng.chassis Motion, and positions in the same units as the chassis geometry. As with approxeng.chassis Pose,
+orientation is measured clockwise from the y axis, so vectors in the robot's frame are rotated clockwise by the
+orientation to get the world frame, as rotate_vector does. NumPy is required.
+"""
+from triangula.kinematics import wheel_matrix
+from triangula.telemetry import FLAG_ENCODERS
+
+#: Encoder counts per wheel revolution, as used by the motion task
+COUNTS_PER_REVOLUTION = 3310
+
+
+def unwrap_counts(counts):
+    """
+    Convert raw unsigned 16 bit encoder counts to signed 64 bit cumulative counts starting from zero. Each step is
+    taken as the shortest way round, so counts must be sampled at least once every half wrap, around ten wheel
+    revolutions.
+
+    :param counts:
+        Array of N raw counts, or N by 3 for three wheels
+    :return:
+        NumPy int64 array of the same shape
+    """
+    import numpy
+    counts = numpy.asarray(counts, dtype=numpy.int64)
+    deltas = (numpy.diff(counts, axis=0) + 32768) % 65536 - 32768
+    unwrapped = numpy.zeros_like(counts)
+    numpy.cumsum(deltas, axis=0, out=unwrapped[1:])
+    return unwrapped
+
+
+def reconstruct_poses(counts, chassis=None, matrix=None, counts_per_revolution: int = COUNTS_PER_REVOLUTION,
+                      initial_pose=(0.0, 0.0, 0.0)):
+    """
+    Integrate a pose trajectory from a sequence of encoder samples. The robot is assumed to move with constant
+    velocity in its own frame between samples, so follows a circular arc, which is integrated exactly rather than as
+    a straight line.
+
+    :param counts:
+        N by 3 array of raw 16 bit encoder counts, one row per sample
+    :param chassis:
+        HoloChassis used to derive the wheel matrix, not needed if matrix is specified
+    :param matrix:
+        Wheel matrix as returned by :func:`wheel_matrix`
+    :param int counts_per_revolution:
+        Encoder counts per wheel revolution
+    :param initial_pose:
+        Pose at the first sample, as x, y and orientation
+    :return:
+        N by 3 NumPy array of x, y and orientation after each sample
+    """
+    import numpy
+    if len(counts) == 0:
+        return numpy.empty((0, 3))
+    if matrix is None:
+        matrix = wheel_matrix(chassis)
+    # Wheel revolutions between samples, mapped back to robot frame motion by the forward kinematics
+    revolutions = numpy.diff(unwrap_counts(counts), axis=0) / counts_per_revolution
+    motion = revolutions @ numpy.linalg.inv(numpy.asarray(matrix, dtype=float)).T
+    dx, dy, dtheta = motion[:, 0], motion[:, 1], motion[:, 2]
+
+    x0, y0, theta0 = initial_pose
+    orientation = numpy.empty(len(dtheta) + 1)
+    orientation[0] = theta0
+    numpy.cumsum(dtheta, out=orientation[1:])
+    orientation[1:] += theta0
+
+    # Displacement along an arc in the frame at the start of each step, using series expansions when the rotation
+    # is small enough that the exact forms would lose precision
+    small = numpy.abs(dtheta) < 1e-6
+    safe = numpy.where(small, 1.0, dtheta)
+    sin_term = numpy.where(small, 1 - dtheta ** 2 / 6, numpy.sin(safe) / safe)
+    cos_term = numpy.where(small, dtheta / 2, (1 - numpy.cos(safe)) / safe)
+    local_x = sin_term * dx + cos_term * dy
+    local_y = sin_term * dy - cos_term * dx
+
+    start = orientation[:-1]
+    cos_start, sin_start = numpy.cos(start), numpy.sin(start)
+    poses = numpy.empty((len(orientation), 3))
+    poses[0] = initial_pose
+    poses[1:, 0] = x0 + numpy.cumsum(cos_start * local_x + sin_start * local_y)
+    poses[1:, 1] = y0 + numpy.cumsum(cos_start * local_y - sin_start * local_x)
+    poses[:, 2] = orientation
+    return poses
+
+
+def reconstruct_log(log, chassis=None, matrix=None, counts_per_revolution: int = COUNTS_PER_REVOLUTION,
+                    initial_pose=(0.0, 0.0, 0.0)):
+    """
+    Reconstruct the pose trajectory from a :class:`triangula.telemetry.TelemetryLog`, using only the records in which
+    encoders were read
+
+    :return:
+        A tuple of an array of encoder read times, and an N by 3 array of poses as from :func:`reconstruct_poses`
+    """
+    import numpy
+    read = (log['flags'] & FLAG_ENCODERS) != 0
+    times = numpy.asarray(log['encoder_time'][read])
+    poses = reconstruct_poses(log.encoders[read], chassis=chassis, matrix=matrix,
+                              counts_per_revolution=counts_per_revolution, initial_pose=initial_pose)
+    return times, poses
@@ -0,0 +1,163 @@
+"""
+Low overhead profiling of hardware transactions. The drivers in :mod:`triangula.hardware` report every transaction to
+a :class:`Profiler`, by default the module level :data:`PROFILER`, which when enabled records the start time,
+duration, bytes moved, retries and errors of each one. Records are kept per device and register in fixed size ring
+buffers allocated when the channel is first seen, so recording doesn't allocate, and when the profiler is disabled
+the cost to the drivers is a single attribute check per transaction.
+
+Enable the profiler at runtime, run for a while, then either look at the summary or write out a trace which can be
+loaded into chrome://tracing or https://ui.perfetto.dev to see exactly where the time goes::
+
+    from triangula.profiling import PROFILER
+
+    PROFILER.enabled = True
+    ...
+    print(PROFILER.summary())
+    PROFILER.write_chrome_trace('/tmp/triangula_trace.json')
+"""
+import json
+from array import array
+from time import perf_counter
+
+
+class Profiler:
+    """
+    Records timing of hardware transactions, grouped into channels by device and register
+    """
+
+    class Channel:
+        """
+        Ring buffers of transaction records for a single device and register
+        """
+        __slots__ = ['device', 'register', 'size', 'count', 'start', 'duration', 'nbytes', 'retries', 'errors']
+
+        def __init__(self, device: str, register, size: int):
+            self.device = device
+            self.register = register
+            self.size = size
+            #: Total number of transactions recorded, including those which have since been overwritten
+            self.count = 0
+            self.start = array('d', bytes(8 * size))
+            self.duration = array('d', bytes(8 * size))
+            self.nbytes = array('l', [0]) * size
+            self.retries = array('l', [0]) * size
+            self.errors = array('b', bytes(size))
+
+        def __len__(self):
+            return min(self.count, self.size)
+
+        @property
+        def name(self) -> str:
+            if self.register is None:
+                return self.device
+            if isinstance(self.register, int):
+                return f'{self.device}:{self.register:#04x}'
+            return f'{self.device}:{self.register}'
+
+        def summary(self) -> dict:
+            n = len(self)
+            durations = sorted(self.duration[:n])
+            return {'count': self.count,
+                    'bytes': sum(self.nbytes[:n]),
+                    'retries': sum(self.retries[:n]),
+                    'errors': sum(self.errors[:n]),
+                    'total_time': sum(durations),
+                    'p50': durations[min(n - 1, int(n * 0.5))] if n else 0.0,
+                    'p99': durations[min(n - 1, int(n * 0.99))] if n else 0.0,
+                    'max': durations[-1] if n else 0.0}
+
+    def __init__(self, size: int = 4096, enabled: bool = False):
+        """
+        Constructor
+
+        :param int size:
+            Number of records to keep for each device and register
+        :param bool enabled:
+            Whether to record transactions initially
+        """
+        self.size = size
+        #: Set to True to record transactions, False to ignore them
+        self.enabled = enabled
+        self._channels = {}
+
+    @staticmethod
+    def clock() -> float:
+        """
+        The clock used for transaction timings, in seconds. Drivers should call this to get the start time of a
+        transaction, but only if the profiler is enabled.
+        """
+        return perf_counter()
+
+    def record(self, device: str, register, start: float, nbytes: int = 0, retries: int = 0, error: bool = False):
+        """
+        Record a transaction which has just finished
+
+        :param str device:
+            Name of the device
+        :param register:
+            Register, or other identifier for the type of transaction, or None
+        :param float start:
+            Time the transaction started, from clock()
+        :param int nbytes:
+            Number of bytes sent and received
+        :param int retries:
+            Number of retries needed
+        :param bool error:
+            True if the transaction failed
+        """
+        end = perf_counter()
+        key = (device, register)
+        channel = self._channels.get(key)
+        if channel is None:
+            channel = self._channels[key] = Profiler.Channel(device, register, self.size)
+        index = channel.count % channel.size
+        channel.start[index] = start
+        channel.duration[index] = end - start
+        channel.nbytes[index] = nbytes
+        channel.retries[index] = retries
+        channel.errors[index] = 1 if error else 0
+        channel.count += 1
+
+    def reset(self):
+        """
+        Discard all records
+        """
+        self._channels = {}
+
+    def summary(self) -> dict:
+        """
+        Summary of the retained records for each channel, keyed by channel name, with the number of transactions,
+        bytes moved, retries, errors, total time, and median, 99th percentile and maximum duration. Times are in
+        seconds.
+        """
+        return {channel.name: channel.summary() for channel in self._channels.values()}
+
+    def chrome_trace(self) -> dict:
+        """
+        Retained records in the Chrome trace event format, with each device shown as a separate thread
+        """
+        events = []
+        devices = {}
+        for channel in self._channels.values():
+            if channel.device not in devices:
+                devices[channel.device] = len(devices) + 1
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': devices[channel.device],
+                               'args': {'name': channel.device}})
+            tid = devices[channel.device]
+            for i in range(len(channel)):
+                events.append({'name': channel.name, 'cat': channel.device, 'ph': 'X', 'pid': 1, 'tid': tid,
+                               'ts': channel.start[i] * 1e6, 'dur': channel.duration[i] * 1e6,
+                               'args': {'bytes': channel.nbytes[i], 'retries': channel.retries[i],
+                                        'error': bool(channel.errors[i])}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_chrome_trace(self, filename: str):
+        """
+        Write the retained records as a Chrome trace JSON file
+        """
+        with open(filename, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+#: Default profiler used by the hardware drivers
+PROFILER = Profiler()
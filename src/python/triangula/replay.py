@@ -0,0 +1,227 @@
+"""
+Offline replay of runs recorded with :class:`triangula.telemetry.TelemetryRecorder`. The recorded joystick inputs and
+encoder counts are fed back through :class:`triangula.manual_motion.ManualMotionTask` with the hardware replaced by
+stand-ins, and the motor powers and poses the task produces are collected. The task runs on a clock driven by the
+recorded timestamps rather than the system clock, so a replay is deterministic and runs as fast as the task can
+compute, which makes it possible to check a change to the control code against a library of recorded runs::
+
+    python -m triangula.replay /home/pi/runs
+
+Replaying a run with unchanged control code closely reproduces the recorded motor powers, so differences show the
+effect of a change. Dead reckoning updates are scheduled from the first recorded tick rather than from when the task
+originally started, and the approxeng motion limits use their own clocks, so small differences are expected where
+these come into play. NumPy is required, as for reading telemetry logs.
+"""
+import argparse
+import glob
+import os
+from functools import partial
+from multiprocessing import Pool
+
+from triangula.hardware import EncoderSample
+from triangula.telemetry import TelemetryLog, button_names, FLAG_JOYSTICK
+
+
+class ReplayClock:
+    """
+    Clock which returns a time set by the replay rather than the real time
+    """
+
+    def __init__(self, time: float = 0.0):
+        self.time = time
+
+    def __call__(self) -> float:
+        return self.time
+
+
+class ReplayJoystick:
+    """
+    Stands in for an approxeng.input controller, presenting recorded axis values and button presses
+    """
+
+    def __init__(self):
+        self.lx = 0.0
+        self.ly = 0.0
+        self.rx = 0.0
+        self.presses = set()
+        self.connected = True
+
+
+class ReplayArduino:
+    """
+    Stands in for :class:`triangula.hardware.Arduino`, returning recorded encoder counts and collecting motor powers
+    """
+
+    def __init__(self):
+        #: Encoder counts returned by encoder_values, set by the replay for each record
+        self.encoder_values = [0, 0, 0]
+        self.encoder_time = 0.0
+        #: Most recent motor powers set
+        self.power = None
+
+    def set_motor_power(self, a, b, c):
+        self.power = (a, b, c)
+
+    def drive_and_sample(self, a, b, c) -> EncoderSample:
+        self.set_motor_power(a, b, c)
+        return EncoderSample(counts=self.encoder_values, timestamp=self.encoder_time)
+
+    def stop(self):
+        self.set_motor_power(0, 0, 0)
+
+
+class ReplayDisplay:
+    """
+    Stands in for :class:`triangula.hardware.P017LCD`, keeping the most recent text and colour
+    """
+
+    def __init__(self):
+        self.text = None
+        self.led0 = None
+
+
+class ReplayResult:
+    """
+    Motor powers and poses produced by replaying a run, as NumPy arrays with one row per recorded tick
+    """
+
+    def __init__(self, filename: str, time, power, pose, recorded_power):
+        self.filename = filename
+        #: Recorded time of each tick
+        self.time = time
+        #: Motor powers set on each tick, N by 3
+        self.power = power
+        #: Pose after each tick, N by 3 as x, y and orientation
+        self.pose = pose
+        #: Motor powers originally recorded, N by 3
+        self.recorded_power = recorded_power
+
+    def __len__(self):
+        return len(self.time)
+
+    @property
+    def max_power_difference(self) -> float:
+        """
+        Largest absolute difference between a replayed and recorded motor power
+        """
+        if not len(self):
+            return 0.0
+        return float(abs(self.power - self.recorded_power).max())
+
+    def save(self, filename: str):
+        """
+        Write the results to a NumPy .npz file
+        """
+        import numpy
+        numpy.savez(filename, time=self.time, power=self.power, pose=self.pose, recorded_power=self.recorded_power)
+
+
+def default_chassis():
+    """
+    Triangula's chassis, as configured in the main script
+    """
+    from approxeng.chassis.util import get_regular_triangular_chassis
+    return get_regular_triangular_chassis(wheel_distance=290, wheel_radius=60, max_rotations_per_second=1.0)
+
+
+def replay(log: TelemetryLog, chassis=None, **task_args) -> ReplayResult:
+    """
+    Replay a recorded run through a new ManualMotionTask
+
+    :param TelemetryLog log:
+        The recorded run
+    :param chassis:
+        HoloChassis to use, defaults to :func:`default_chassis`
+    :param task_args:
+        Any other arguments are passed to the ManualMotionTask constructor, to replay with different settings
+    :return:
+        A :class:`ReplayResult`
+    """
+    import numpy
+    from triangula.manual_motion import ManualMotionTask
+
+    chassis = chassis or default_chassis()
+    records = log.records
+    count = len(records)
+    clock = ReplayClock(float(records['time'][0]) if count else 0.0)
+    task = ManualMotionTask(clock=clock, **task_args)
+    arduino = ReplayArduino()
+    display = ReplayDisplay()
+    joystick = ReplayJoystick()
+    task.initialise(chassis=chassis, display=display)
+
+    # Pull the columns out as lists, indexing memory mapped arrays one element at a time is slow
+    times = records['time'].tolist()
+    flags = records['flags'].tolist()
+    lx, ly, rx = records['lx'].tolist(), records['ly'].tolist(), records['rx'].tolist()
+    buttons = records['buttons'].tolist()
+    encoders = log.encoders.tolist()
+    encoder_times = records['encoder_time'].tolist()
+
+    power = numpy.zeros((count, 3))
+    pose = numpy.zeros((count, 3))
+    for i in range(count):
+        clock.time = times[i]
+        if flags[i] & FLAG_JOYSTICK:
+            joystick.lx, joystick.ly, joystick.rx = lx[i], ly[i], rx[i]
+            joystick.presses = set(button_names(buttons[i]))
+        else:
+            joystick.presses = set()
+        # The record holds the most recent counts read at or before this tick
+        arduino.encoder_values = encoders[i]
+        arduino.encoder_time = encoder_times[i]
+        task.manual_motion(arduino=arduino, display=display, joystick=joystick, chassis=chassis)
+        power[i] = arduino.power
+        current = task.dead_reckoning.pose
+        pose[i] = (current.position.x, current.position.y, current.orientation)
+    return ReplayResult(filename=log.filename, time=numpy.array(times), power=power, pose=pose,
+                        recorded_power=log.power.astype(float))
+
+
+def replay_file(filename: str, **task_args) -> ReplayResult:
+    """
+    Replay a recorded run from a telemetry file, see :func:`replay`
+    """
+    return replay(TelemetryLog(filename), **task_args)
+
+
+def replay_directory(directory: str, pattern: str = '*.tlm', processes: int = None, **task_args) -> dict:
+    """
+    Replay every recorded run in a directory, spread across a pool of processes
+
+    :param str directory:
+        Directory containing telemetry files
+    :param str pattern:
+        Glob pattern matching the telemetry files within the directory
+    :param int processes:
+        Number of processes, defaults to the number of CPUs
+    :param task_args:
+        Passed to the ManualMotionTask constructor for every run
+    :return:
+        A dict of filename to :class:`ReplayResult`
+    """
+    filenames = sorted(glob.glob(os.path.join(directory, pattern)))
+    with Pool(processes=processes) as pool:
+        results = pool.map(partial(replay_file, **task_args), filenames)
+    return dict(zip(filenames, results))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Replay recorded Triangula runs through the manual motion task')
+    parser.add_argument('directory', help='directory containing telemetry files')
+    parser.add_argument('--pattern', default='*.tlm', help='glob pattern for telemetry files')
+    parser.add_argument('--processes', type=int, default=None, help='number of processes, defaults to CPU count')
+    parser.add_argument('--output', help='directory to write a .npz file of results for each run to')
+    options = parser.parse_args(args)
+
+    results = replay_directory(options.directory, pattern=options.pattern, processes=options.processes)
+    for filename, result in results.items():
+        print(f'{os.path.basename(filename)}: {len(result)} ticks, '
+              f'max power difference {result.max_power_difference:.4f}')
+        if options.output:
+            name = os.path.splitext(os.path.basename(filename))[0] + '.npz'
+            result.save(os.path.join(options.output, name))
+
+
+if __name__ == '__main__':
+    main()
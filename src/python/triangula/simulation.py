@@ -0,0 +1,559 @@
+"""
+Simulated hardware, so the drivers in :mod:`triangula.hardware`, and the tasks built on them, can be run and
+benchmarked on a machine which isn't Triangula.
+
+:class:`SimulatedI2C` stands in for an ``smbus2.SMBus``, routing transactions to simulated devices by address, with
+configurable latency and error injection. :class:`SimulatedArduino` models the Arduino firmware's register protocol,
+including checksums, protocol versions and encoder counts driven by the commanded motor powers, and
+:class:`SimulatedMPU9150` models the IMU registers. :class:`SimulatedSerial` stands in for a ``serial.Serial`` and
+models the P017 LCD's command set.
+
+The simplest way to use these is through :class:`SimulatedHardware`, which wires everything together and creates the
+real drivers on top of the simulated devices::
+
+    hardware = SimulatedHardware(chassis=chassis)
+    register_resource('arduino', hardware.create_arduino())
+    register_resource('mpu', hardware.create_mpu())
+    register_resource('display', hardware.create_lcd())
+"""
+import ctypes
+import random
+import struct
+from math import exp, sin
+from time import monotonic, sleep
+
+import serial
+
+from triangula.hardware import I2CBus, Arduino, MPU9150, P017LCD
+
+# Flag set on I2C messages which read from the device, as in linux/i2c.h
+I2C_M_RD = 0x0001
+# Errno raised by the kernel when a device doesn't acknowledge
+EREMOTEIO = 121
+
+
+class SimulatedI2C:
+    """
+    Simulated I2C bus with the same interface as ``smbus2.SMBus``. Each transaction is passed to the simulated device
+    at the target address as a sequence of writes, each a list of bytes, and reads of a given length.
+    """
+
+    def __init__(self, latency: float = 0.0, byte_time: float = 0.0, error_rate: float = 0.0, seed=None):
+        """
+        Constructor
+
+        :param float latency:
+            Time in seconds each transaction takes, in addition to the time per byte
+        :param float byte_time:
+            Time in seconds to transfer each byte, around 90us at the standard 100kHz bus speed
+        :param float error_rate:
+            Probability, from 0 to 1.0, that a transaction fails with an IOError as if not acknowledged
+        :param seed:
+            Seed for the random number generator used for error injection
+        """
+        self.latency = latency
+        self.byte_time = byte_time
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.devices = {}
+        #: Number of transactions and bytes moved, and number of errors injected
+        self.transactions = 0
+        self.bytes = 0
+        self.errors = 0
+
+    def attach(self, address: int, device):
+        """
+        Attach a simulated device, which must have write(data) and read(length) methods
+        """
+        self.devices[address] = device
+        return device
+
+    def open(self, bus: int = 1) -> 'SimulatedI2C':
+        """
+        Factory for :class:`triangula.hardware.I2CBus`, returns this bus whatever the bus number
+        """
+        return self
+
+    def close(self):
+        pass
+
+    def _device(self, address: int, nbytes: int):
+        self.transactions += 1
+        self.bytes += nbytes
+        delay = self.latency + nbytes * self.byte_time
+        if delay > 0:
+            sleep(delay)
+        if address not in self.devices:
+            raise IOError(EREMOTEIO, f'no device at address {address:#04x}')
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors += 1
+            raise IOError(EREMOTEIO, 'Remote I/O error (simulated)')
+        return self.devices[address]
+
+    def write_byte(self, i2c_addr, value, force=None):
+        self._device(i2c_addr, 1).write([value])
+
+    def read_byte(self, i2c_addr, force=None):
+        return self._device(i2c_addr, 1).read(1)[0]
+
+    def write_byte_data(self, i2c_addr, register, value, force=None):
+        self._device(i2c_addr, 2).write([register, value])
+
+    def read_byte_data(self, i2c_addr, register, force=None):
+        device = self._device(i2c_addr, 2)
+        device.write([register])
+        return device.read(1)[0]
+
+    def write_i2c_block_data(self, i2c_addr, register, data, force=None):
+        self._device(i2c_addr, len(data) + 1).write([register] + list(data))
+
+    def read_i2c_block_data(self, i2c_addr, register, length, force=None):
+        device = self._device(i2c_addr, length + 1)
+        device.write([register])
+        return device.read(length)
+
+    def i2c_rdwr(self, *i2c_msgs):
+        for msg in i2c_msgs:
+            device = self._device(msg.addr, msg.len)
+            if msg.flags & I2C_M_RD:
+                ctypes.memmove(msg.buf, bytes(device.read(msg.len)), msg.len)
+            else:
+                device.write(list(msg))
+
+
+class SimulatedArduino:
+    """
+    Simulates the Arduino firmware in Triangula_Main.ino. Commands are validated and acted on as in the firmware, and
+    reads are answered as the firmware's requestEvent handler would, including the version 1 one byte per read
+    behaviour and, for later protocol versions, register select frame reads.
+
+    Each wheel's speed follows the commanded power with a first order lag, reaching the wheel's maximum rotation
+    speed at full power, and the encoder counts are the integral of wheel speed, wrapping at 16 bits as the firmware's
+    do. Time comes from the supplied clock, so a simulation can be run faster than real time by supplying a clock
+    which is advanced explicitly.
+    """
+
+    MOTOR_SPEED_SET = 0x20
+    SET_SOLID_COLOUR = 0x21
+    ENCODER_READ = 0x22
+    UPDATE_LED_GROUP = 0x23
+    PROTOCOL_VERSION_READ = 0x24
+    ENCODER_READ_BLOCK = 0x25
+    DRIVE_AND_SAMPLE = 0x26
+    MAX_SENT_BYTES = 26
+    NUM_LEDS = 48
+    # FastLED hues used for the wheel speed bars on each pylon
+    HUE_PURPLE = 192
+    HUE_ORANGE = 32
+
+    def __init__(self, chassis=None, counts_per_revolution=3310, max_rotations_per_second=1.0,
+                 motor_time_constant=0.05, protocol=3, clock=monotonic):
+        """
+        Constructor
+
+        :param chassis:
+            Optional :class:`approxeng.chassis.HoloChassis`, if specified the maximum speed of each wheel is taken
+            from the chassis, otherwise all wheels have max_rotations_per_second as their maximum speed
+        :param int counts_per_revolution:
+            Encoder counts per wheel revolution
+        :param float max_rotations_per_second:
+            Wheel speed at full power, if no chassis is specified
+        :param float motor_time_constant:
+            Time constant in seconds of the lag between commanded power and wheel speed, 0 for no lag
+        :param int protocol:
+            Firmware protocol version to simulate, from 1 to 3
+        :param clock:
+            Function returning the current time in seconds
+        """
+        if chassis is not None:
+            self.max_speeds = [wheel.maximum_rotation_per_second for wheel in chassis.wheels]
+        else:
+            self.max_speeds = [max_rotations_per_second] * 3
+        self.counts_per_revolution = counts_per_revolution
+        self.motor_time_constant = motor_time_constant
+        self.protocol = protocol
+        self.clock = clock
+        #: Motor values as sent to the motor drivers, -128 to 127
+        self.motor_values = [0, 0, 0]
+        #: Current wheel speeds in revolutions per second
+        self.wheel_speeds = [0.0, 0.0, 0.0]
+        #: Encoder positions, unwrapped, in counts
+        self.positions = [0.0, 0.0, 0.0]
+        #: Pixel colours as HSV byte triples
+        self.pixels = [(170, 255, 60)] * self.NUM_LEDS
+        #: Number of commands rejected due to bad checksums, and unknown commands
+        self.bad_checksums = 0
+        self.unknown_commands = 0
+        self._start_time = clock()
+        self._last_time = self._start_time
+        self._selected_register = 0
+        self._legacy_data = [0] * 6
+        self._legacy_index = 6
+        self._sequence = 0
+
+    @property
+    def encoder_counts(self):
+        """
+        Encoder counts as the firmware holds them, unsigned 16 bit values
+        """
+        return [int(position) & 0xFFFF for position in self.positions]
+
+    def advance(self, now=None):
+        """
+        Bring wheel speeds and encoder positions up to date with the clock
+        """
+        if now is None:
+            now = self.clock()
+        dt = now - self._last_time
+        if dt <= 0:
+            return
+        self._last_time = now
+        for i in range(3):
+            # Firmware sends power bytes to the motors as value - 128, the driver negates powers before sending
+            target = -self.motor_values[i] / 128 * self.max_speeds[i]
+            if self.motor_time_constant > 0:
+                # Exact solution of the first order lag over the interval, integrating the position as we go
+                decay = exp(-dt / self.motor_time_constant)
+                start_speed = self.wheel_speeds[i]
+                self.positions[i] += (target * dt + (start_speed - target) * self.motor_time_constant * (1 - decay)) \
+                                     * self.counts_per_revolution
+                self.wheel_speeds[i] = target + (start_speed - target) * decay
+            else:
+                self.wheel_speeds[i] = target
+                self.positions[i] += target * dt * self.counts_per_revolution
+
+    def _check_command(self, data, length):
+        # Validate a command with length bytes after the register, followed by an XOR checksum
+        if len(data) < length + 2:
+            return False
+        xor = 0
+        for b in data[:length + 1]:
+            xor ^= b
+        if xor != data[length + 1]:
+            self.bad_checksums += 1
+            return False
+        return True
+
+    def write(self, data):
+        self.advance()
+        if len(data) == 1 and self.protocol >= 2:
+            self._selected_register = data[0]
+            return
+        data = data[:self.MAX_SENT_BYTES]
+        command = data[0]
+        if command in (self.MOTOR_SPEED_SET, self.DRIVE_AND_SAMPLE) and \
+                (command == self.MOTOR_SPEED_SET or self.protocol >= 3):
+            if self._check_command(data, 3):
+                self.motor_values = [b - 128 for b in data[1:4]]
+                for pylon in range(3):
+                    self._show_wheel_speed(pylon, data[1 + pylon])
+            if command == self.DRIVE_AND_SAMPLE:
+                self._selected_register = command
+        elif command == self.SET_SOLID_COLOUR:
+            if self._check_command(data, 3):
+                self.pixels = [tuple(data[1:4])] * self.NUM_LEDS
+        elif command == self.ENCODER_READ:
+            counts = self.encoder_counts
+            # Firmware sends pos_c first, the driver reads the counts in the order sent
+            self._legacy_data = [b for count in counts for b in ((count >> 8) & 0xFF, count & 0xFF)]
+            self._legacy_index = 0
+        elif command == self.UPDATE_LED_GROUP and len(data) > 2 and data[2] <= (self.MAX_SENT_BYTES - 4) // 3:
+            if self._check_command(data, 2 + data[2] * 3):
+                for offset in range(data[2]):
+                    if data[1] + offset < self.NUM_LEDS:
+                        self.pixels[data[1] + offset] = tuple(data[3 + offset * 3:6 + offset * 3])
+        else:
+            # Unknown command, firmware stops the motors and sets the lights to red
+            self.unknown_commands += 1
+            self.motor_values = [0, 0, 0]
+            self.pixels = [(0, 255, 50)] * self.NUM_LEDS
+
+    def _show_wheel_speed(self, pylon, value):
+        # As the firmware's setColoursForWheelSpeed, a bar on the pylon's eight pixels lengthening with motor speed
+        if value >= 128:
+            lit = (value - 112) >> 4
+            colours = [(self.HUE_PURPLE, 200, 200) if n <= lit else (0, 0, 0) for n in range(8)]
+        else:
+            lit = (143 - value) >> 4
+            colours = [(self.HUE_ORANGE, 200, 200) if 8 - n <= lit else (0, 0, 0) for n in range(8)]
+        self.pixels[pylon * 8:pylon * 8 + 8] = colours
+
+    def read(self, length):
+        self.advance()
+        register = self._selected_register
+        self._selected_register = 0
+        if register == self.PROTOCOL_VERSION_READ:
+            response = [self.protocol]
+        elif register in (self.ENCODER_READ_BLOCK, self.DRIVE_AND_SAMPLE):
+            response = []
+            for count in self.encoder_counts:
+                response += [(count >> 8) & 0xFF, count & 0xFF]
+            if register == self.DRIVE_AND_SAMPLE:
+                micros = int((self._last_time - self._start_time) * 1e6) & 0xFFFFFFFF
+                response += list(struct.pack('>I', micros))
+            response.append(self._sequence)
+            self._sequence = (self._sequence + 1) & 0xFF
+            xor = register
+            for b in response:
+                xor ^= b
+            response.append(xor)
+        elif self._legacy_index < 6:
+            response = [self._legacy_data[self._legacy_index]]
+            self._legacy_index += 1
+        else:
+            response = [0]
+        # Reading more than the slave sends gets 0xFF for the remaining bytes
+        return (response + [0xFF] * length)[:length]
+
+
+class SimulatedMPU9150:
+    """
+    Simulates the MPU9150 register file. Writes set registers, reads return consecutive registers from the one
+    selected. The accelerometer, temperature and gyro output registers are filled from the accel, gyro and
+    temperature attributes, scaled according to the configured ranges, whenever they're read.
+    """
+
+    def __init__(self, gyro_source=None):
+        """
+        Constructor
+
+        :param gyro_source:
+            Optional function returning the gyro rates in degrees per second as an x, y, z tuple, used in place of
+            the gyro attribute if specified
+        """
+        self.registers = bytearray(128)
+        # Sleep bit set on power up
+        self.registers[0x6B] = 0x40
+        #: Acceleration in meters per second squared
+        self.accel = (0.0, 0.0, 9.80665)
+        #: Gyro rates in degrees per second
+        self.gyro = (0.0, 0.0, 0.0)
+        #: Temperature in degrees Celsius
+        self.temperature = 25.0
+        self.gyro_source = gyro_source
+        self._pointer = 0
+
+    def _fill_outputs(self):
+        accel_range = 2 << ((self.registers[MPU9150.ACCEL_CONFIG] & 0x18) >> 3)
+        gyro_range = 250 << ((self.registers[MPU9150.GYRO_CONFIG] & 0x18) >> 3)
+        gyro = self.gyro_source() if self.gyro_source is not None else self.gyro
+
+        def clamp(value):
+            return max(-32768, min(32767, int(round(value))))
+
+        raw = [clamp(a * 32768 / (accel_range * MPU9150.GRAVITIY_MS2)) for a in self.accel] + \
+              [clamp((self.temperature - 35) * 340)] + \
+              [clamp(g * 32768 / gyro_range) for g in gyro]
+        self.registers[MPU9150.SENSOR_OUT:MPU9150.SENSOR_OUT + 14] = struct.pack('>7h', *raw)
+
+    def write(self, data):
+        self._pointer = data[0]
+        for offset, value in enumerate(data[1:]):
+            self.registers[(self._pointer + offset) & 0x7F] = value
+
+    def read(self, length):
+        self._fill_outputs()
+        data = [self.registers[(self._pointer + offset) & 0x7F] for offset in range(length)]
+        self._pointer = (self._pointer + length) & 0x7F
+        return data
+
+
+class SimulatedSerial:
+    """
+    Simulated serial port with a P017 LCD attached, with the same interface as ``serial.Serial`` as far as the
+    display driver is concerned. Commands are carriage return terminated; 'pc' commands send an instruction to the
+    display controller, 'pd' writes characters at the cursor, and 'pb' sets the backlight.
+    """
+
+    ROW_ADDRESSES = [0x00, 0x40, 0x14, 0x54]
+
+    def __init__(self, columns=16, rows=2, realtime=False, error_rate=0.0, seed=None):
+        """
+        Constructor
+
+        :param int columns:
+            Display width
+        :param int rows:
+            Display height
+        :param bool realtime:
+            If True, writes block for the time it would take to transmit the data at the configured baud rate
+        :param float error_rate:
+            Probability, from 0 to 1.0, that a write fails with a SerialException
+        :param seed:
+            Seed for the random number generator used for error injection
+        """
+        self.columns = columns
+        self.row_count = rows
+        self.realtime = realtime
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.baudrate = 9600
+        self.is_open = False
+        #: Display RAM, 128 characters
+        self.ram = [' '] * 128
+        self.address = 0
+        #: Backlight colour as red, green, blue from 0 to 10
+        self.backlight = (10, 10, 10)
+        #: Total bytes written, and the time they'd have taken at the configured baud rate
+        self.bytes_written = 0
+        self.busy_time = 0.0
+        self._pending = b''
+
+    def __call__(self, port=None, baudrate=9600, write_timeout=None, **kwargs):
+        """
+        Factory for :class:`triangula.hardware.P017LCD`, opens and returns this port
+        """
+        self.baudrate = baudrate
+        self.is_open = True
+        return self
+
+    @property
+    def rows(self):
+        """
+        Text currently visible on the display, one string per row
+        """
+        return [''.join(self.ram[address:address + self.columns])
+                for address in self.ROW_ADDRESSES[:self.row_count]]
+
+    def close(self):
+        self.is_open = False
+
+    def write(self, data: bytes):
+        if self.error_rate and self.random.random() < self.error_rate:
+            raise serial.SerialException('simulated write failure')
+        # Ten bits per byte with start and stop bits
+        duration = len(data) * 10 / self.baudrate
+        self.bytes_written += len(data)
+        self.busy_time += duration
+        if self.realtime:
+            sleep(duration)
+        self._pending += data
+        *commands, self._pending = self._pending.split(b'\r')
+        for command in commands:
+            self._command(command.decode('UTF-8'))
+        return len(data)
+
+    def _command(self, command: str):
+        if command.startswith('pc'):
+            instruction = int(command[2:])
+            if instruction == 1:
+                self.ram = [' '] * 128
+                self.address = 0
+            elif instruction == 2:
+                self.address = 0
+            elif instruction & 0x80:
+                self.address = instruction & 0x7F
+        elif command.startswith('pd'):
+            for character in command[2:]:
+                self.ram[self.address] = character
+                self.address = (self.address + 1) & 0x7F
+        elif command.startswith('pb'):
+            self.backlight = tuple(int(value) for value in command[2:].split(','))
+
+
+class SimulatedJoystick:
+    """
+    Stands in for an approxeng.input controller, with the analogue axes used by the motion task following smooth
+    sweeps with a little noise, as a person driving around would produce. Call update() with the current time to move
+    the sticks, and press() to queue button presses which will show up in presses after the next check_presses().
+    """
+
+    def __init__(self, noise=0.01, seed=None):
+        """
+        Constructor
+
+        :param float noise:
+            Amplitude of random noise added to each axis
+        :param seed:
+            Seed for the random number generator used for noise
+        """
+        self.noise = noise
+        self.random = random.Random(seed)
+        self.lx = 0.0
+        self.ly = 0.0
+        self.rx = 0.0
+        self.presses = set()
+        self.connected = True
+        self._pending = set()
+
+    def update(self, t: float):
+        """
+        Move the sticks to their positions at time t seconds
+        """
+        def axis(value):
+            return max(-1.0, min(1.0, value + self.random.uniform(-self.noise, self.noise)))
+
+        self.lx = axis(0.8 * sin(t * 0.7))
+        self.ly = axis(0.9 * sin(t * 0.5 + 1.0))
+        self.rx = axis(0.5 * sin(t * 0.3 + 2.0))
+
+    def press(self, *buttons):
+        """
+        Queue button presses, by name
+        """
+        self._pending.update(buttons)
+
+    def check_presses(self):
+        """
+        Make queued button presses visible in presses, clearing any from the previous check
+        """
+        self.presses = self._pending
+        self._pending = set()
+        return self.presses
+
+
+class SimulatedHardware:
+    """
+    A complete set of simulated hardware, an I2C bus with an Arduino and MPU9150 attached and a serial port with an
+    LCD attached, along with methods to create the real drivers on top of them
+    """
+
+    def __init__(self, chassis=None, clock=monotonic, protocol=3, latency=0.0, byte_time=0.0, error_rate=0.0,
+                 motor_time_constant=0.05, realtime_serial=False, seed=None):
+        """
+        Constructor
+
+        :param chassis:
+            Optional chassis from which to take wheel maximum speeds
+        :param clock:
+            Function returning the current time in seconds, used to drive the simulated wheels
+        :param int protocol:
+            Arduino firmware protocol version to simulate
+        :param float latency:
+            Time in seconds for each I2C transaction
+        :param float byte_time:
+            Time in seconds for each byte transferred over I2C
+        :param float error_rate:
+            Probability of each I2C transaction failing
+        :param float motor_time_constant:
+            Time constant of the simulated motors' response to power changes
+        :param bool realtime_serial:
+            Whether serial writes block for the time they'd take at the configured baud rate
+        :param seed:
+            Random seed for error injection
+        """
+        self.i2c = SimulatedI2C(latency=latency, byte_time=byte_time, error_rate=error_rate, seed=seed)
+        self.arduino = self.i2c.attach(0x70, SimulatedArduino(chassis=chassis, protocol=protocol, clock=clock,
+                                                              motor_time_constant=motor_time_constant))
+        self.mpu = self.i2c.attach(0x68, SimulatedMPU9150())
+        self.display = SimulatedSerial(realtime=realtime_serial, seed=seed)
+        self.bus = I2CBus(bus=1, factory=self.i2c.open)
+
+    def create_arduino(self, **kwargs) -> Arduino:
+        """
+        Create an :class:`triangula.hardware.Arduino` driver attached to the simulated Arduino
+        """
+        return Arduino(bus=self.bus, **kwargs)
+
+    def create_mpu(self, **kwargs) -> MPU9150:
+        """
+        Create a :class:`triangula.hardware.MPU9150` driver attached to the simulated IMU
+        """
+        return MPU9150(bus=self.bus, **kwargs)
+
+    def create_lcd(self, **kwargs) -> P017LCD:
+        """
+        Create a :class:`triangula.hardware.P017LCD` driver attached to the simulated display
+        """
+        kwargs.setdefault('min_delay', 0)
+        return P017LCD(serial_factory=self.display, **kwargs)
@@ -0,0 +1,297 @@
+"""
+High rate telemetry recording. A :class:`TelemetryRecorder` collects joystick inputs, motor powers, encoder counts,
+IMU frames and pose into fixed layout binary records, one per control loop tick, packed into preallocated buffers. Full
+buffers are handed to a background thread which writes them to disk, so the control loop never waits on the file
+system. The resulting files can be read back with :class:`TelemetryLog`, which memory maps the file and presents each
+field as a NumPy array (NumPy is only needed for reading logs, not for recording them).
+
+The drivers in :mod:`triangula.hardware` feed the recorder with the values they send and receive if their telemetry
+attribute is set, and :class:`triangula.manual_motion.ManualMotionTask` adds joystick inputs and pose and commits a
+record on each tick::
+
+    recorder = TelemetryRecorder('/home/pi/run.tlm')
+    arduino.telemetry = recorder
+    register_task(name='manual_motion', value=ManualMotionTask(telemetry=recorder))
+    ...
+    recorder.close()
+
+Files start with a 16 byte header: an 8 byte magic string, the record size and the number of fields, both as little
+endian 32 bit unsigned values. This is followed by records laid out as in :data:`FIELDS`, little endian with no
+padding.
+"""
+import logging
+import os
+import struct
+from queue import Queue, Empty
+from threading import RLock, Thread
+from time import monotonic
+
+LOG = logging.getLogger('triangula.telemetry')
+
+#: Record fields, as name and struct format character
+FIELDS = [('time', 'd'),
+          ('lx', 'f'), ('ly', 'f'), ('rx', 'f'),
+          ('buttons', 'H'),
+          ('flags', 'H'),
+          ('power_a', 'f'), ('power_b', 'f'), ('power_c', 'f'),
+          ('encoder_a', 'H'), ('encoder_b', 'H'), ('encoder_c', 'H'),
+          ('encoder_time', 'd'),
+          ('accel_x', 'f'), ('accel_y', 'f'), ('accel_z', 'f'),
+          ('temperature', 'f'),
+          ('gyro_x', 'f'), ('gyro_y', 'f'), ('gyro_z', 'f'),
+          ('pose_x', 'f'), ('pose_y', 'f'), ('pose_orientation', 'f')]
+
+RECORD = struct.Struct('<' + ''.join(code for _, code in FIELDS))
+HEADER = struct.Struct('<8sII')
+MAGIC = b'TRITLM01'
+
+# Bits in the flags field, showing which groups of fields were updated in each record, fields which weren't updated
+# hold the last value set
+FLAG_JOYSTICK = 0x01
+FLAG_POWER = 0x02
+FLAG_ENCODERS = 0x04
+FLAG_IMU = 0x08
+FLAG_POSE = 0x10
+
+#: Buttons recorded in the buttons field, bit n set if BUTTONS[n] was pressed
+BUTTONS = ['triangle', 'square', 'circle', 'cross', 'select', 'start', 'home']
+
+_INDEX = {name: i for i, (name, _) in enumerate(FIELDS)}
+
+
+def button_mask(presses) -> int:
+    """
+    Convert a collection of button presses, such as a controller's presses property, to a bit mask of
+    :data:`BUTTONS`
+    """
+    mask = 0
+    for bit, button in enumerate(BUTTONS):
+        if button in presses:
+            mask |= 1 << bit
+    return mask
+
+
+def button_names(mask: int) -> list:
+    """
+    Convert a bit mask of :data:`BUTTONS` back to a list of button names
+    """
+    return [button for bit, button in enumerate(BUTTONS) if mask & (1 << bit)]
+
+
+class TelemetryRecorder:
+    """
+    Records telemetry to a binary file. Set values with the set methods, then call commit() to write a record
+    containing the current values. Calls are serialised by a lock, so drivers running on a worker thread, such as an
+    Arduino behind a :class:`triangula.worker.ThreadedArduino`, can set values while the control loop commits records.
+    Each record holds whatever values had been set, from any thread, when it was committed.
+    """
+
+    def __init__(self, filename: str, block_records: int = 2048, buffers: int = 4, clock=monotonic):
+        """
+        Constructor
+
+        :param str filename:
+            File to write, will be overwritten if it exists
+        :param int block_records:
+            Number of records in each buffer, each full buffer is written to disk as a single block
+        :param int buffers:
+            Number of buffers. If the writer thread falls this many blocks behind, records are dropped rather than
+            stalling the caller.
+        :param clock:
+            Function returning the current time in seconds, used to timestamp records
+        """
+        self.clock = clock
+        self._file = open(filename, 'wb')
+        self._file.write(HEADER.pack(MAGIC, RECORD.size, len(FIELDS)))
+        self._block_records = block_records
+        self._free = Queue()
+        for _ in range(buffers):
+            self._free.put(bytearray(RECORD.size * block_records))
+        self._full = Queue()
+        self._buffer = self._free.get()
+        self._count = 0
+        self._values = [0] * len(FIELDS)
+        self._flags = 0
+        # Held by close() while it flushes, so reentrant
+        self._lock = RLock()
+        #: Number of records written, and dropped because the writer thread fell behind
+        self.records = 0
+        self.dropped = 0
+        self._writer = Thread(target=self._write_blocks, name='triangula-telemetry', daemon=True)
+        self._writer.start()
+
+    def set_joystick(self, lx: float, ly: float, rx: float, presses=()):
+        """
+        Set joystick axes and button presses
+        """
+        with self._lock:
+            values = self._values
+            values[1] = lx
+            values[2] = ly
+            values[3] = rx
+            values[4] = button_mask(presses)
+            self._flags |= FLAG_JOYSTICK
+
+    def set_power(self, a: float, b: float, c: float):
+        """
+        Set motor powers, from -1.0 to 1.0
+        """
+        with self._lock:
+            values = self._values
+            values[6] = a
+            values[7] = b
+            values[8] = c
+            self._flags |= FLAG_POWER
+
+    def set_encoders(self, counts, timestamp: float = None):
+        """
+        Set raw 16 bit encoder counts, and the time at which they were read if known
+        """
+        with self._lock:
+            values = self._values
+            values[9] = counts[0]
+            values[10] = counts[1]
+            values[11] = counts[2]
+            values[12] = self.clock() if timestamp is None else timestamp
+            self._flags |= FLAG_ENCODERS
+
+    def set_imu(self, frame):
+        """
+        Set IMU values from a :class:`triangula.hardware.IMUFrame`
+        """
+        with self._lock:
+            self._values[13:20] = frame
+            self._flags |= FLAG_IMU
+
+    def set_pose(self, pose):
+        """
+        Set pose from an approxeng.chassis Pose
+        """
+        with self._lock:
+            values = self._values
+            values[20] = pose.position.x
+            values[21] = pose.position.y
+            values[22] = pose.orientation
+            self._flags |= FLAG_POSE
+
+    def commit(self, t: float = None):
+        """
+        Write a record with the current values, and clear the flags and button presses ready for the next one
+
+        :param float t:
+            Time of the record, read from the clock if not specified
+        """
+        with self._lock:
+            if self._buffer is None:
+                # All buffers are waiting to be written, see if one has come free
+                try:
+                    self._buffer = self._free.get_nowait()
+                except Empty:
+                    self.dropped += 1
+                    self._flags = 0
+                    return
+            values = self._values
+            values[0] = self.clock() if t is None else t
+            values[5] = self._flags
+            RECORD.pack_into(self._buffer, self._count * RECORD.size, *values)
+            self._count += 1
+            self.records += 1
+            self._flags = 0
+            values[4] = 0
+            if self._count == self._block_records:
+                self._hand_off()
+
+    def _hand_off(self):
+        self._full.put((self._buffer, self._count))
+        self._count = 0
+        try:
+            self._buffer = self._free.get_nowait()
+        except Empty:
+            self._buffer = None
+
+    def flush(self):
+        """
+        Hand any buffered records to the writer thread
+        """
+        with self._lock:
+            if self._buffer is not None and self._count:
+                self._hand_off()
+
+    def close(self):
+        """
+        Write all remaining records and close the file
+        """
+        # Hold the lock so no record can be committed after the flush and lost
+        with self._lock:
+            self.flush()
+            self._full.put(None)
+        self._writer.join()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _write_blocks(self):
+        while True:
+            block = self._full.get()
+            if block is None:
+                return
+            buffer, count = block
+            try:
+                self._file.write(memoryview(buffer)[:count * RECORD.size])
+            except IOError:
+                LOG.exception('unable to write telemetry')
+            self._free.put(buffer)
+
+
+class TelemetryLog:
+    """
+    Read access to a telemetry file. The file is memory mapped, and each field is available as a NumPy array, either
+    as log['field'] or log.field, so even long logs can be opened instantly and analysed without copying.
+    """
+
+    def __init__(self, filename: str):
+        import numpy
+        with open(filename, 'rb') as f:
+            magic, record_size, field_count = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or record_size != RECORD.size or field_count != len(FIELDS):
+            raise ValueError(f'{filename} is not a telemetry file in the expected format')
+        numpy_types = {'d': '<f8', 'f': '<f4', 'H': '<u2'}
+        self.dtype = numpy.dtype([(name, numpy_types[code]) for name, code in FIELDS])
+        self.filename = filename
+        #: The records as a NumPy structured array
+        if os.path.getsize(filename) > HEADER.size:
+            self.records = numpy.memmap(filename, dtype=self.dtype, mode='r', offset=HEADER.size)
+        else:
+            # Can't memory map an empty region
+            self.records = numpy.zeros(0, dtype=self.dtype)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, name):
+        return self.records[name]
+
+    def __getattr__(self, name):
+        if name in _INDEX:
+            return self.records[name]
+        raise AttributeError(name)
+
+    @property
+    def encoders(self):
+        """
+        Encoder counts as an N by 3 array
+        """
+        import numpy
+        return numpy.stack([self.records['encoder_a'], self.records['encoder_b'], self.records['encoder_c']], axis=1)
+
+    @property
+    def power(self):
+        """
+        Motor powers as an N by 3 array
+        """
+        import numpy
+        return numpy.stack([self.records['power_a'], self.records['power_b'], self.records['power_c']], axis=1)
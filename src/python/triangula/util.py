@@ -1,4 +1,7 @@
-from time import time, sleep as time_sleep
+from array import array
+from heapq import heappush, heappop
+from math import floor
+from time import monotonic, sleep as time_sleep
 
 
 class IntervalCheck:
@@ -34,7 +37,7 @@ class IntervalCheck:
         Determines whether the necessary interval has elapsed. If it has, this returns True and updates the internal
         record of the last runtime to be 'now'. If the necessary time has not elapsed this returns False
         """
-        now = time()
+        now = monotonic()
         if self.last_time is None or now - self.last_time > self.interval:
             self.last_time = now
             return True
@@ -47,7 +50,7 @@ class IntervalCheck:
         set it as a side effect, but will not sleep in this case. Calling sleep() repeatedly will therefore not sleep
         on the first invocation but will subsequently do so each time.
         """
-        now = time()
+        now = monotonic()
         if self.last_time is None:
             self.last_time = now
             return
@@ -62,4 +65,304 @@ class IntervalCheck:
         self.sleep()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.last_time = time()
+        self.last_time = monotonic()
+
+
+class Scheduler:
+    """
+    Runs a set of periodic jobs, each at its own fixed rate, against the monotonic clock. Jobs are held in a heap
+    ordered by their next deadline, so rather than polling each job in turn the caller can ask for the next deadline
+    and sleep until then.
+
+    Deadlines advance by exactly one interval each time a job runs, so unlike :class:`IntervalCheck` a job doesn't
+    drift later by however late it was picked up. If a job falls more than a whole interval behind the missed runs are
+    skipped rather than run back to back, and counted as overruns. Each job also tracks its jitter, the time between
+    its deadline and the point at which it was found to be due.
+    """
+
+    class Job:
+        """
+        A periodic job within a :class:`Scheduler`
+        """
+        __slots__ = ['name', 'interval', 'function', 'deadline', 'runs', 'overruns', 'last_jitter', 'max_jitter',
+                     'total_jitter']
+
+        def __init__(self, name, interval, function, deadline):
+            self.name = name
+            self.interval = interval
+            self.function = function
+            self.deadline = deadline
+            #: Number of times the job has been due
+            self.runs = 0
+            #: Number of deadlines missed entirely because the job was more than an interval late
+            self.overruns = 0
+            #: Lateness of the most recent run, in seconds
+            self.last_jitter = 0.0
+            #: Maximum lateness over all runs, in seconds
+            self.max_jitter = 0.0
+            self.total_jitter = 0.0
+
+        @property
+        def mean_jitter(self):
+            """
+            Mean lateness over all runs, in seconds
+            """
+            return self.total_jitter / self.runs if self.runs else 0.0
+
+        def __repr__(self):
+            return f'Job(name={self.name}, interval={self.interval}, runs={self.runs}, overruns={self.overruns}, ' \
+                   f'mean_jitter={self.mean_jitter:.6f}, max_jitter={self.max_jitter:.6f})'
+
+    def __init__(self, clock=monotonic, sleep=time_sleep):
+        """
+        Constructor
+
+        :param clock:
+            Function returning the current time in seconds, defaults to time.monotonic
+        :param sleep:
+            Function to sleep for a number of seconds, defaults to time.sleep
+        """
+        self.clock = clock
+        self._sleep = sleep
+        self._heap = []
+        self._jobs = {}
+        self._sequence = 0
+        self._due = set()
+
+    def add(self, name, interval=None, rate=None, function=None, start=None):
+        """
+        Add a periodic job, specifying either an interval or a rate
+
+        :param name:
+            Name of the job, must be unique within this scheduler
+        :param float interval:
+            Seconds between runs
+        :param float rate:
+            Runs per second, used if interval isn't specified
+        :param function:
+            Optional function to call with no arguments when the job is due, used by run_pending()
+        :param float start:
+            Clock time of the first deadline, defaults to now so the job is due immediately
+        :return:
+            The new :class:`Scheduler.Job`
+        """
+        if name in self._jobs:
+            raise ValueError(f'job {name} already scheduled')
+        if interval is None:
+            if not rate:
+                raise ValueError('either interval or rate must be specified')
+            interval = 1.0 / rate
+        job = Scheduler.Job(name=name, interval=interval, function=function,
+                            deadline=self.clock() if start is None else start)
+        self._jobs[name] = job
+        self._push(job)
+        return job
+
+    def remove(self, name):
+        """
+        Remove a job
+        """
+        job = self._jobs.pop(name)
+        self._heap = [entry for entry in self._heap if entry[2] is not job]
+        self._heap.sort()
+
+    def reset(self, now=None):
+        """
+        Make every job due immediately and clear their statistics, as if they had just been added. Use this when
+        starting to run jobs some time after they were added, otherwise the gap is counted as missed deadlines.
+
+        :param float now:
+            Clock time of the first deadline, read from the clock if not specified
+        """
+        if now is None:
+            now = self.clock()
+        self._heap = []
+        for job in self._jobs.values():
+            job.deadline = now
+            job.runs = 0
+            job.overruns = 0
+            job.last_jitter = 0.0
+            job.max_jitter = 0.0
+            job.total_jitter = 0.0
+            self._push(job)
+
+    def __getitem__(self, name) -> 'Scheduler.Job':
+        return self._jobs[name]
+
+    def __iter__(self):
+        return iter(self._jobs.values())
+
+    def _push(self, job):
+        # Sequence number breaks ties between jobs with identical deadlines, so jobs themselves are never compared
+        self._sequence += 1
+        heappush(self._heap, (job.deadline, self._sequence, job))
+
+    def due(self, now=None):
+        """
+        Find all jobs whose deadline has passed, update their statistics and schedule their next deadlines.
+
+        :param float now:
+            Current clock time, read from the clock if not specified
+        :return:
+            A set containing the names of all jobs which are due. The same set is cleared and reused on every call to
+            avoid allocating one each time, so copy it if it's needed after the next call.
+        """
+        if now is None:
+            now = self.clock()
+        due = self._due
+        due.clear()
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            _, _, job = heappop(heap)
+            jitter = now - job.deadline
+            job.runs += 1
+            job.last_jitter = jitter
+            job.total_jitter += jitter
+            if jitter > job.max_jitter:
+                job.max_jitter = jitter
+            # Next deadline is the first whole interval strictly after now. Rounding in the division can land it a
+            # few ULP at or before now, which would make the job due again straight away, so step on if it does.
+            missed = floor(jitter / job.interval)
+            deadline = job.deadline + job.interval * (missed + 1)
+            while deadline <= now:
+                missed += 1
+                deadline += job.interval
+            job.overruns += missed
+            job.deadline = deadline
+            self._push(job)
+            due.add(job.name)
+        return due
+
+    def run_pending(self, now=None):
+        """
+        Call the function of every job which is due, in deadline order
+
+        :return:
+            The set of names of jobs which were due
+        """
+        due = set(self.due(now))
+        for job in sorted((self._jobs[name] for name in due), key=lambda j: j.deadline):
+            if job.function is not None:
+                job.function()
+        return due
+
+    def next_deadline(self):
+        """
+        Clock time of the earliest deadline, or None if there are no jobs
+        """
+        return self._heap[0][0] if self._heap else None
+
+    def time_to_next(self, now=None):
+        """
+        Seconds until the earliest deadline, zero if it's already passed, None if there are no jobs
+        """
+        deadline = self.next_deadline()
+        if deadline is None:
+            return None
+        return max(0.0, deadline - (self.clock() if now is None else now))
+
+    def sleep_until_next(self):
+        """
+        Sleep until the earliest deadline, returning immediately if it's already passed or there are no jobs
+        """
+        delay = self.time_to_next()
+        if delay:
+            self._sleep(delay)
+
+
+class RollingStats:
+    """
+    Keeps the most recent values of some measurement, such as a loop period, in a fixed size ring buffer, and
+    reports percentiles over them. Adding a value is cheap, the sorting needed for percentiles is only done when
+    they're requested.
+    """
+
+    def __init__(self, size=1000):
+        """
+        Constructor
+
+        :param int size:
+            Number of most recent values to keep
+        """
+        self._values = array('d', bytes(8 * size))
+        self._size = size
+        #: Total number of values added
+        self.count = 0
+
+    def add(self, value: float):
+        """
+        Add a value, replacing the oldest if the buffer is full
+        """
+        self._values[self.count % self._size] = value
+        self.count += 1
+
+    def reset(self):
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self._size)
+
+    def percentile(self, p: float) -> float:
+        """
+        Get the value below which p percent of the retained values fall, or 0 if there aren't any values
+        """
+        n = len(self)
+        if n == 0:
+            return 0.0
+        values = sorted(self._values[:n])
+        return values[min(n - 1, int(n * p / 100))]
+
+    @property
+    def p50(self) -> float:
+        return self.percentile(50)
+
+    @property
+    def p99(self) -> float:
+        return self.percentile(99)
+
+    @property
+    def max(self) -> float:
+        n = len(self)
+        return max(self._values[:n]) if n else 0.0
+
+    def summary(self) -> dict:
+        """
+        Count, median, 99th percentile and maximum as a dict
+        """
+        n = len(self)
+        values = sorted(self._values[:n])
+        if n == 0:
+            return {'count': 0, 'p50': 0.0, 'p99': 0.0, 'max': 0.0}
+        return {'count': n,
+                'p50': values[min(n - 1, int(n * 0.5))],
+                'p99': values[min(n - 1, int(n * 0.99))],
+                'max': values[-1]}
+
+
+class LoopTiming:
+    """
+    Timing statistics for a control loop. Each tick records the time since the start of the previous tick, the time
+    spent waiting on hardware, and the time spent in computation. All times are in seconds.
+    """
+
+    def __init__(self, size=1000):
+        #: :class:`RollingStats` of the time between the starts of consecutive ticks
+        self.period = RollingStats(size)
+        #: :class:`RollingStats` of the time within each tick spent on hardware I/O
+        self.io = RollingStats(size)
+        #: :class:`RollingStats` of the time within each tick spent on everything other than I/O
+        self.compute = RollingStats(size)
+        #: Number of ticks which should have happened but didn't because the loop was running late
+        self.missed_deadlines = 0
+
+    def reset(self):
+        self.period.reset()
+        self.io.reset()
+        self.compute.reset()
+        self.missed_deadlines = 0
+
+    def summary(self) -> dict:
+        return {'period': self.period.summary(),
+                'io': self.io.summary(),
+                'compute': self.compute.summary(),
+                'missed_deadlines': self.missed_deadlines}
@@ -0,0 +1,302 @@
+"""
+Background I/O for the hardware drivers. All the drivers in :mod:`triangula.hardware` block while they talk to their
+devices, which is fine when called occasionally but means that within the task loop a single slow device holds up
+everything else. The classes here move that I/O onto a separate thread.
+
+An :class:`IOWorker` runs commands submitted from the task loop, and periodically polls sensors in the background,
+caching the most recent values. Commands are keyed, and a command submitted while an earlier one with the same key is
+still waiting replaces it, so if the worker falls behind it only ever sends the most recent motor power or display
+text rather than working through a backlog of stale ones.
+
+:class:`ThreadedArduino`, :class:`ThreadedLCD` and :class:`ThreadedMPU9150` wrap the corresponding drivers to present
+the same interface, but route all calls through a worker, so they can be registered as resources in place of the
+drivers themselves::
+
+    worker = IOWorker()
+    worker.start()
+    register_resource('arduino', ThreadedArduino(arduino=Arduino(bus=i2c_bus), worker=worker))
+    register_resource('display', ThreadedLCD(lcd=P017LCD(), worker=worker))
+"""
+import logging
+from threading import Thread, Condition
+from time import monotonic
+
+from approxeng.hwsupport import add_properties
+
+from triangula.hardware import Arduino, P017LCD, MPU9150
+
+LOG = logging.getLogger('triangula.worker')
+
+
+class IOWorker(Thread):
+    """
+    Thread which runs hardware commands and sensor polls in the background
+    """
+
+    class Poll:
+        """
+        A function called periodically by the worker, the last result of which is cached
+        """
+
+        def __init__(self, function, interval: float):
+            self.function = function
+            self.interval = interval
+            self.next_time = monotonic()
+            self.value = None
+            self.time = None
+
+    def __init__(self, name='triangula-io'):
+        super().__init__(name=name, daemon=True)
+        self._condition = Condition()
+        self._commands = {}
+        self._polls = {}
+        self._running = True
+        #: Number of commands and polls which have raised an exception
+        self.errors = 0
+
+    def submit(self, key, function, *args):
+        """
+        Queue a command to be run on the worker thread. If there's already a command with the same key waiting to be
+        run it is replaced by this one, keeping its position in the queue.
+
+        :param key:
+            Key for the command, commands with the same key are assumed to supersede each other
+        :param function:
+            Function to call
+        :param args:
+            Arguments to pass to the function
+        """
+        with self._condition:
+            self._commands[key] = (function, args)
+            self._condition.notify()
+
+    def poll(self, key, function, interval: float):
+        """
+        Call a function every interval seconds in the background, caching the result which can then be retrieved
+        with latest(key). The first call is made synchronously, so there's always a cached value available.
+
+        :param key:
+            Key under which to cache the result
+        :param function:
+            Function to call, with no arguments
+        :param float interval:
+            Seconds between calls
+        """
+        poll = IOWorker.Poll(function=function, interval=interval)
+        self._run_poll(poll)
+        with self._condition:
+            self._polls[key] = poll
+            self._condition.notify()
+
+    def latest(self, key, default=None):
+        """
+        Get the most recent result from a poll, or the default if there isn't one
+        """
+        poll = self._polls.get(key)
+        return default if poll is None or poll.time is None else poll.value
+
+    def latest_time(self, key):
+        """
+        Get the monotonic clock time at which the most recent result from a poll was read, or None if not available
+        """
+        poll = self._polls.get(key)
+        return None if poll is None else poll.time
+
+    def stop(self, timeout=1.0):
+        """
+        Stop the worker thread, running any commands still waiting in the queue before it exits
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self.is_alive():
+            self.join(timeout=timeout)
+
+    def run(self):
+        while True:
+            with self._condition:
+                while self._running and not self._commands:
+                    now = monotonic()
+                    due = min((poll.next_time for poll in self._polls.values()), default=None)
+                    if due is not None and due <= now:
+                        break
+                    self._condition.wait(timeout=None if due is None else due - now)
+                commands = list(self._commands.values())
+                self._commands.clear()
+                polls = list(self._polls.values())
+                running = self._running
+            for function, args in commands:
+                try:
+                    function(*args)
+                except Exception:
+                    self.errors += 1
+                    LOG.exception('error running background hardware command')
+            if not running:
+                return
+            now = monotonic()
+            for poll in polls:
+                if poll.next_time <= now:
+                    self._run_poll(poll)
+
+    def _run_poll(self, poll: 'IOWorker.Poll'):
+        # Schedule from the previous due time to avoid drift, unless we've fallen a whole interval behind
+        poll.next_time = max(poll.next_time + poll.interval, monotonic())
+        try:
+            poll.value = poll.function()
+            poll.time = monotonic()
+        except Exception:
+            self.errors += 1
+            LOG.exception('error polling hardware')
+
+
+class ThreadedArduino:
+    """
+    Wraps an :class:`triangula.hardware.Arduino` so that commands are sent from an :class:`IOWorker` and encoder
+    values are read in the background. Motor powers, lighting and pixel updates are coalesced so only the most recent
+    of each is sent if the worker falls behind.
+    """
+
+    def __init__(self, arduino: Arduino, worker: IOWorker, encoder_interval: float = 0.02):
+        """
+        Constructor
+
+        :param Arduino arduino:
+            The Arduino to wrap
+        :param IOWorker worker:
+            Worker which will send commands and read encoders
+        :param float encoder_interval:
+            Seconds between encoder reads
+        """
+        self.arduino = arduino
+        self.worker = worker
+        self._sample = None
+        worker.poll(key=(id(self), 'encoders'), function=lambda: arduino.encoder_values, interval=encoder_interval)
+        add_properties(board=self, leds=[0])
+        self.led0_brightness = arduino.led0_brightness
+        self.led0_gamma = arduino.led0_gamma
+
+    def _set_led_rgb(self, led: int = 0, red: float = 0, green: float = 0, blue: float = 0):
+        self.worker.submit((id(self), 'led', led), self.arduino._set_led_rgb, led, red, green, blue)
+
+    def set_pixels(self, start: int, hsv_array):
+        """
+        Queue pixel colours, see :meth:`triangula.hardware.Arduino.set_pixels`
+        """
+        self.worker.submit((id(self), 'pixels', start, len(hsv_array)), self.arduino.set_pixels, start,
+                           list(hsv_array))
+
+    def set_motor_power(self, a, b, c):
+        """
+        Queue motor powers, values from -1.0 to 1.0
+        """
+        self.worker.submit((id(self), 'motor_power'), self.arduino.set_motor_power, a, b, c)
+
+    def drive_and_sample(self, a, b, c):
+        """
+        Queue motor powers to be sent along with an encoder read, see
+        :meth:`triangula.hardware.Arduino.drive_and_sample`. This replaces any motor powers still waiting to be sent.
+        As the exchange happens in the background, the sample returned is the one from the most recent exchange to
+        complete, typically the previous call's, or None if none has completed yet.
+        """
+        self.worker.submit((id(self), 'motor_power'), self._drive_and_sample, a, b, c)
+        return self._sample
+
+    def _drive_and_sample(self, a, b, c):
+        sample = self.arduino.drive_and_sample(a, b, c)
+        if sample is not None:
+            self._sample = sample
+
+    def _stop(self, **kwargs):
+        """
+        Stop the motors. Called by the stop() method which add_properties injects in place of any stop() defined
+        here, after it has turned off the LED.
+        """
+        self.set_motor_power(0, 0, 0)
+
+    @property
+    def encoder_values(self):
+        """
+        Most recent raw values from the three rotary encoders attached to the motors
+        """
+        return self.worker.latest((id(self), 'encoders'))
+
+    @property
+    def encoder_time(self):
+        """
+        Monotonic clock time at which the current encoder_values were read
+        """
+        return self.worker.latest_time((id(self), 'encoders'))
+
+    @property
+    def cumulative_counts(self):
+        """
+        Signed cumulative encoder counts, see :attr:`triangula.hardware.Arduino.cumulative_counts`
+        """
+        return self.arduino.cumulative_counts
+
+
+class ThreadedLCD:
+    """
+    Wraps a :class:`triangula.hardware.P017LCD` so that all writes to the display are made from an
+    :class:`IOWorker`. Text and backlight updates are coalesced, so only the most recent text is written if the
+    worker falls behind.
+    """
+
+    def __init__(self, lcd: P017LCD, worker: IOWorker):
+        self.lcd = lcd
+        self.worker = worker
+        self._text = None
+        add_properties(board=self, leds=[0])
+
+    @property
+    def text(self):
+        return self._text
+
+    @text.setter
+    def text(self, new_text):
+        """
+        Queue new text, see :attr:`triangula.hardware.P017LCD.text`
+        """
+        self._text = new_text
+        self.worker.submit((id(self), 'text'), setattr, self.lcd, 'text', new_text)
+
+    def clear(self):
+        self._text = None
+        self.worker.submit((id(self), 'text'), self.lcd.clear)
+
+    def cursor_off(self):
+        self.worker.submit((id(self), 'cursor'), self.lcd.cursor_off)
+
+    def cursor_blink(self):
+        self.worker.submit((id(self), 'cursor'), self.lcd.cursor_blink)
+
+    def cursor_on(self):
+        self.worker.submit((id(self), 'cursor'), self.lcd.cursor_on)
+
+    def _set_led_rgb(self, led: int = 0, red: float = 0, green: float = 0, blue: float = 0):
+        self.worker.submit((id(self), 'led', led), self.lcd._set_led_rgb, led, red, green, blue)
+
+
+class ThreadedMPU9150:
+    """
+    Wraps a :class:`triangula.hardware.MPU9150`, reading frames in the background so read_frame() returns
+    immediately with the most recent sample
+    """
+
+    def __init__(self, mpu: MPU9150, worker: IOWorker, interval: float = 0.005):
+        self.mpu = mpu
+        self.worker = worker
+        worker.poll(key=(id(self), 'frame'), function=mpu.read_frame, interval=interval)
+
+    def read_frame(self):
+        """
+        Most recent :class:`triangula.hardware.IMUFrame`
+        """
+        return self.worker.latest((id(self), 'frame'))
+
+    @property
+    def frame_time(self):
+        """
+        Monotonic clock time at which the current frame was read
+        """
+        return self.worker.latest_time((id(self), 'frame'))